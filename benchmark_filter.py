@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+
+"""!@brief Compare the filter engines of function_filter across kernel sizes.
+
+Run from the QGIS plugins folder with : python -m HistoricalMap.benchmark_filter
+"""
+
+from __future__ import annotations
+
+import time
+
+import numpy as np
+from scipy import ndimage
+
+import HistoricalMap.function_filter as ffilter
+
+
+def benchmark_median(
+    sizes=(3, 5, 7, 9, 11, 13, 15, 21), shape=(1024, 1024), dtype="uint8"
+):
+    """!@brief Time the scipy and histogram median engines on a random closed image.
+
+    Input:
+        sizes : kernel sizes to test (tuple of int)
+        shape : size of the test image (tuple of int)
+        dtype : data type of the test image, 'uint8' or 'uint16' (str)
+    Output:
+        results : list of (size, scipy time, histogram time, same output) tuples
+    """
+    np.random.seed(0)
+    high = np.iinfo(dtype).max + 1
+    temp = np.random.randint(0, high, size=shape).astype(dtype)
+    # Closing makes the random image look like the input of the median filter
+    temp = ndimage.grey_closing(temp, size=(5, 5))
+
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        ref = ndimage.median_filter(temp, size=(size, size))
+        tScipy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        out = ffilter.median_filter_histogram(temp, size)
+        tHistogram = time.perf_counter() - start
+
+        results.append((size, tScipy, tHistogram, np.array_equal(ref, out)))
+    return results
+
+
+def benchmark_closing(sizes=(3, 5, 11, 21, 31, 51), shape=(1024, 1024)):
+    """!@brief Time the scipy and separable grey closing engines on a random image.
+
+    Input:
+        sizes : kernel sizes to test (tuple of int)
+        shape : size of the test image (tuple of int)
+    Output:
+        results : list of (size, scipy time, separable time, same output) tuples
+    """
+    np.random.seed(0)
+    temp = np.random.randint(0, 256, size=shape).astype("uint8")
+    output = np.empty_like(temp)
+
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        ref = ndimage.grey_closing(temp, size=(size, size))
+        tScipy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ffilter.grey_closing_separable(temp, size, output=output)
+        tSeparable = time.perf_counter() - start
+
+        results.append((size, tScipy, tSeparable, np.array_equal(ref, output)))
+    return results
+
+
+if __name__ == "__main__":
+    print("Median filter")
+    print(f"{'size':>6}{'scipy (s)':>12}{'histogram (s)':>16}{'same':>7}")
+    for size, tScipy, tHistogram, same in benchmark_median():
+        print(f"{size:>6}{tScipy:>12.3f}{tHistogram:>16.3f}{str(same):>7}")
+
+    print("Grey closing")
+    print(f"{'size':>6}{'scipy (s)':>12}{'separable (s)':>16}{'same':>7}")
+    for size, tScipy, tSeparable, same in benchmark_closing():
+        print(f"{size:>6}{tScipy:>12.3f}{tSeparable:>16.3f}{str(same):>7}")
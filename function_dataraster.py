@@ -4,8 +4,19 @@
 
 from __future__ import annotations
 
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, gdal_array
+from scipy import ndimage
+
+import HistoricalMap.gmm_ridge as gmmr
 
 
 def open_data_band(filename: str):
@@ -130,16 +141,217 @@ def create_empty_tiff(outname: str, im, d, GeoTransform, Projection):
 #    dst_ds = None
 
 
-def get_samples_from_roi(raster_name: str, roi_name):
+def resample_image(inRaster: str, outRaster: str, inResolution: float, inLabels=False):
+    """!@brief Resample an image to a coarser ground resolution.
+
+    Bands of an image are averaged, a raster of labels takes the most frequent label.
+    Nothing is done if the image is already at the resolution or coarser.
+        Input:
+            inRaster: the name of the image
+            outRaster: the name of the resampled image
+            inResolution: pixel size to reach, in the unit of the projection (float)
+            inLabels: True if the raster contains class labels (bool)
+        Output:
+            outRaster: the name of the image to use (inRaster if nothing was done)
+            factor: size of the new pixels in pixels of the input image (float)
+    """
+    data = gdal.Open(inRaster, gdal.GA_ReadOnly)
+    geo = data.GetGeoTransform()
+    data = None
+    pixelSize = min(abs(geo[1]), abs(geo[5]))
+    if inResolution is None or inResolution <= pixelSize:
+        return inRaster, 1.0
+
+    gdal.Warp(
+        outRaster,
+        inRaster,
+        format="GTiff",
+        xRes=inResolution,
+        yRes=inResolution,
+        resampleAlg="mode" if inLabels else "average",
+    )
+    return outRaster, inResolution / pixelSize
+
+
+def get_map_mask(inRaster: str, outMask: str, inSize=2048, inTolerance=40):
+    """!@brief Detect the map inside the collar of a scanned sheet and save it as a mask.
+
+    The sheet is read decimated to inSize pixels. Regions with the colour of the border
+    (paper, or the scanner background) that touch the border are the collar; this is done a
+    second time from the border of what remains, for a sheet scanned with a background around
+    it. The map is the biggest remaining region, holes filled, as it is closed by the neatline.
+    The mask keeps this decimated size, use read_mask to get it at the size of an image.
+        Input:
+            inRaster: the name of the scanned sheet
+            outMask: the name of the mask (1 on the map, 0 outside)
+            inSize: size of the biggest side of the mask (int)
+            inTolerance: maximal difference with the colour of the collar, per band (int)
+        Output:
+            outMask: the name of the mask
+    """
+    data = gdal.Open(inRaster, gdal.GA_ReadOnly)
+    nc, nl, d = data.RasterXSize, data.RasterYSize, data.RasterCount
+    factor = max(1.0, max(nc, nl) / inSize)
+    mc, ml = max(1, int(round(nc / factor))), max(1, int(round(nl / factor)))
+    im = np.empty((ml, mc, d), dtype=np.float32)
+    for i in range(d):
+        im[:, :, i] = data.GetRasterBand(i + 1).ReadAsArray(
+            buf_xsize=mc, buf_ysize=ml, resample_alg=gdal.GRIORA_Average
+        )
+
+    valid = np.ones((ml, mc), dtype=bool)
+    for step in range(2):
+        ring = valid & ~ndimage.binary_erosion(valid, border_value=0)
+        colour = np.median(im[ring], axis=0)
+        similar = valid & (np.abs(im - colour).max(axis=2) < inTolerance)
+        labels = ndimage.label(similar)[0]
+        collar = np.isin(labels, np.unique(labels[ring & similar]))
+        if collar.sum() < 0.01 * valid.sum():
+            break
+        labels, n = ndimage.label(valid & ~collar)
+        if n == 0:
+            break
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        valid = ndimage.binary_fill_holes(labels == sizes.argmax())
+
+    # Nothing sensible was found, keep the whole image
+    if valid.sum() < 0.1 * valid.size:
+        valid[:] = True
+
+    geo = list(data.GetGeoTransform())
+    geo[1], geo[2] = geo[1] * nc / mc, geo[2] * nl / ml
+    geo[4], geo[5] = geo[4] * nc / mc, geo[5] * nl / ml
+    driver = gdal.GetDriverByName("GTiff")
+    dst_ds = driver.Create(outMask, mc, ml, 1, gdal.GDT_Byte)
+    dst_ds.SetGeoTransform(geo)
+    dst_ds.SetProjection(data.GetProjection())
+    dst_ds.GetRasterBand(1).WriteArray(valid.astype(np.uint8))
+    dst_ds = None
+    data = None
+    return outMask
+
+
+def get_mask_name(inRaster: str):
+    """!@brief Name of the mask of the map detected on a raster (raster_mask.tif)"""
+    return os.path.splitext(inRaster)[0] + "_mask.tif"
+
+
+def read_mask(band, window, nl: int, nc: int):
+    """!@brief Read a window of a mask at the size of an image covering the same extent.
+
+    The mask can be smaller than the image (see get_map_mask), it is read with the nearest
+    pixel.
+        Input:
+            band: the band of the mask
+            window: (xoff, yoff, xsize, ysize) window of the image
+            nl: number of lines of the image (int)
+            nc: number of columns of the image (int)
+        Output:
+            mask: True where the window is on the map (bool array)
+    """
+    xoff, yoff, xsize, ysize = window
+    if band.XSize == nc and band.YSize == nl:
+        return band.ReadAsArray(*window) != 0
+
+    fx, fy = band.XSize / nc, band.YSize / nl
+    cols = np.minimum((np.arange(xoff, xoff + xsize) + 0.5) * fx, band.XSize - 1)
+    rows = np.minimum((np.arange(yoff, yoff + ysize) + 0.5) * fy, band.YSize - 1)
+    cols, rows = cols.astype(int), rows.astype(int)
+    temp = band.ReadAsArray(
+        int(cols[0]),
+        int(rows[0]),
+        int(cols[-1] - cols[0] + 1),
+        int(rows[-1] - rows[0] + 1),
+    )
+    return temp[np.ix_(rows - rows[0], cols - cols[0])] != 0
+
+
+def get_random_positions(n: int, k: int, rng):
+    """!@brief Draw k distinct positions at random in range(n), in O(k) memory.
+
+    Positions are drawn with replacement and the duplicates drawn again, so the population is
+    never materialized. Every set of k positions is equally likely; k should be at most n / 2
+    for a few draws to be enough.
+        Input:
+            n: size of the population (int)
+            k: number of positions (int)
+            rng: random generator (numpy Generator)
+        Output:
+            positions: the sorted positions (int64 array)
+    """
+    positions = np.empty(0, dtype=np.int64)
+    while positions.size < k:
+        positions = np.union1d(positions, rng.integers(0, n, k - positions.size))
+    return positions
+
+
+def get_envelope_window(inGeoTransform, inEnvelope, nl: int, nc: int):
+    """!@brief Window of the pixels of an image under an envelope.
+
+    One pixel is added on each side, as rasterized pixels are burnt from their center.
+        Input:
+            inGeoTransform: the geotransform of the image
+            inEnvelope: (xmin, xmax, ymin, ymax) envelope in the projection of the image
+            nl: number of lines of the image (int)
+            nc: number of columns of the image (int)
+        Output:
+            window: (xoff, yoff, xsize, ysize) clipped to the image, None if it is outside
+    """
+    inv = gdal.InvGeoTransform(inGeoTransform)
+    xmin, xmax, ymin, ymax = inEnvelope
+    corners = [
+        gdal.ApplyGeoTransform(inv, x, y) for x in (xmin, xmax) for y in (ymin, ymax)
+    ]
+    c0 = max(0, int(np.floor(min(c[0] for c in corners))) - 1)
+    c1 = min(nc - 1, int(np.floor(max(c[0] for c in corners))) + 1)
+    l0 = max(0, int(np.floor(min(c[1] for c in corners))) - 1)
+    l1 = min(nl - 1, int(np.floor(max(c[1] for c in corners))) + 1)
+    if c0 > c1 or l0 > l1:
+        return None
+    return c0, l0, c1 - c0 + 1, l1 - l0 + 1
+
+
+def get_samples_from_roi(
+    raster_name: str,
+    roi_name,
+    inEnvelopes=None,
+    inWindow=None,
+    inMaxSamples=None,
+    inSeed: int = 0,
+    inJobs: int = 1,
+    inStats=None,
+):
     """!@brief Get the set of pixels given the thematic map.
-    Get the set of pixels given the thematic map. Both map should be of same size. Data is read per block.
+    Get the set of pixels given the thematic map. Both map should be of same size, or the thematic map
+    should have the size of inWindow. Data is read per block.
+    A first pass counts the referenced pixels of each block in the thematic map, so the samples are
+    then copied once in arrays of the right size.
+    If the envelopes of the training features are given, only the blocks they touch are read.
+    With inMaxSamples, classes with more pixels are sampled at random without replacement: as the
+    first pass counts the pixels of each class, the pixels to keep are drawn before the second one
+    and the other ones are never copied. Only the drawn positions are kept (see
+    get_random_positions), in O(inMaxSamples) memory per class.
+    With inJobs, blocks are read by several threads, each with its own handles on the files, and
+    copied at their place in the output (GDAL does not hold the GIL while reading).
+    With inStats, the samples are not kept: the statistics of each block are computed while it is
+    read and merged in inStats, so a GMM is learned on a whole sheet in O(C.d^2) memory.
         Input:
             raster_name: the name of the raster file, could be any file that GDAL can open
             roi_name: the name of the thematic image: each pixel whose values is greater than 0 is returned
+            inEnvelopes: (xmin, xmax, ymin, ymax) envelopes of the features in the projection of the
+                raster, None to read all the blocks (list)
+            inWindow: (xoff, yoff, xsize, ysize) window of the raster covered by the thematic image,
+                None if it covers the whole raster
+            inMaxSamples: maximum number of pixels per class, None to keep them all (int)
+            inSeed: seed of the random selection of the pixels (int)
+            inJobs: number of threads reading the blocks (int)
+            inStats: statistics of the samples to update instead of returning them (gmm_ridge.GMMStats)
         Output:
             X: the sample matrix. A nXd matrix, where n is the number of referenced pixels and d is the number of variables. Each
-                line of the matrix is a pixel.
+                line of the matrix is a pixel. It has the data type of the raster.
             Y: the label of the pixel
+            (X and Y are None with inStats)
     Written by Mathieu Fauvel.
     """
 
@@ -156,9 +368,10 @@ def get_samples_from_roi(raster_name: str, roi_name):
         exit()
 
     ## Some tests
-    if (raster.RasterXSize != roi.RasterXSize) or (
-        raster.RasterYSize != roi.RasterYSize
-    ):
+    if inWindow is None:
+        inWindow = (0, 0, raster.RasterXSize, raster.RasterYSize)
+    xoff, yoff, xsize, ysize = inWindow
+    if (xsize != roi.RasterXSize) or (ysize != roi.RasterYSize):
         print("Images should be of the same size")
         exit()
 
@@ -174,47 +387,568 @@ def get_samples_from_roi(raster_name: str, roi_name):
     nc = raster.RasterXSize
     nl = raster.RasterYSize
 
+    ## Get the blocks of the raster in the window, clipped to it
+    blocks = []
+    for i in range(yoff - yoff % y_block_size, yoff + ysize, y_block_size):
+        top = max(i, yoff)
+        lines = min(i + y_block_size, yoff + ysize) - top
+        for j in range(xoff - xoff % x_block_size, xoff + xsize, x_block_size):
+            left = max(j, xoff)
+            cols = min(j + x_block_size, xoff + xsize) - left
+            blocks.append((left, top, cols, lines))
+
+    ## Keep the blocks touched by the features
+    if inEnvelopes is not None:
+        geo = raster.GetGeoTransform()
+        touched = set()
+        for envelope in inEnvelopes:
+            window = get_envelope_window(geo, envelope, nl, nc)
+            if window is None:
+                continue
+            c0, l0, c1, l1 = window[0], window[1], sum(window[::2]), sum(window[1::2])
+            for bi in range(l0 // y_block_size, (l1 - 1) // y_block_size + 1):
+                for bj in range(c0 // x_block_size, (c1 - 1) // x_block_size + 1):
+                    touched.add((bj, bi))
+        blocks = [
+            block
+            for block in blocks
+            if (block[0] // x_block_size, block[1] // y_block_size) in touched
+        ]
+
+    ## Count the referenced pixels of each class in each block
+    roiBand = roi.GetRasterBand(1)
+    roiBlocks = [(j - xoff, i - yoff, cols, lines) for j, i, cols, lines in blocks]
+    counts = [np.bincount(roiBand.ReadAsArray(*block).ravel()) for block in roiBlocks]
+    classCounts = np.zeros(max([count.size for count in counts] + [1]), dtype=np.int64)
+    for count in counts:
+        classCounts[: count.size] += count
+    classCounts[0] = 0
+
+    ## Draw the pixels kept in the classes with too many of them, in the order they are read
+    ## When most of them are kept, the dropped ones are drawn instead
+    keep = {}
+    if inMaxSamples is not None:
+        rng = np.random.default_rng(inSeed)
+        for c in np.nonzero(classCounts > inMaxSamples)[0]:
+            drop = inMaxSamples > classCounts[c] // 2
+            size = classCounts[c] - inMaxSamples if drop else inMaxSamples
+            keep[c] = (get_random_positions(classCounts[c], size, rng), drop)
+            classCounts[c] = inMaxSamples
+    n = int(classCounts.sum())
+
+    ## Place of the samples of each block in the output
+    jobs = []
+    seen = dict.fromkeys(keep, 0)
+    start = 0
+    for block, roiBlock, count in zip(blocks, roiBlocks, counts):
+        selection = {}
+        kept = int(count[1:].sum())
+        for c, (positions, drop) in keep.items():
+            if c < count.size and count[c] > 0:
+                # Positions drawn among the pixels of the class in this block
+                first, last = np.searchsorted(positions, [seen[c], seen[c] + count[c]])
+                selection[c] = (positions[first:last] - seen[c], drop)
+                if drop:
+                    kept -= last - first
+                else:
+                    kept -= count[c] - (last - first)
+                seen[c] += count[c]
+        if kept > 0:
+            jobs.append((block, roiBlock, start, selection))
+            start += kept
+
     ## Read block data
-    X = np.array([]).reshape(0, d)
-    Y = np.array([]).reshape(0, 1)
-    for i in range(0, nl, y_block_size):
-        if i + y_block_size < nl:  # Check for size consistency in Y
-            lines = y_block_size
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(raster.GetRasterBand(1).DataType)
+    # try:
+    if inStats is None:
+        X = np.empty((n, d), dtype=dtype)
+        Y = np.empty((n, 1), dtype=np.uint8)
+    else:
+        X, Y = None, None
+    # except MemoryError:
+    #     print("Impossible to allocate memory: ROI too big")
+    #     exit()
+
+    # Each thread reads with its own handles, this one uses the opened files
+    local = threading.local()
+    local.raster, local.roi = raster, roi
+
+    def extract(job):
+        block, roiBlock, start, selection = job
+        if not hasattr(local, "raster"):
+            local.raster = gdal.Open(raster_name, gdal.GA_ReadOnly)
+            local.roi = gdal.Open(roi_name, gdal.GA_ReadOnly)
+
+        # Load the reference data
+        ROI = local.roi.GetRasterBand(1).ReadAsArray(*roiBlock)
+        t = np.nonzero(ROI)
+        labels = ROI[t]
+        if selection:
+            selected = np.ones(labels.size, dtype=bool)
+            for c, (positions, drop) in selection.items():
+                keepClass = np.full(np.count_nonzero(labels == c), drop)
+                keepClass[positions] = not drop
+                selected[labels == c] = keepClass
+            t = (t[0][selected], t[1][selected])
+            labels = labels[selected]
+        count = labels.size
+        if inStats is not None:
+            # Only the statistics of the block are kept
+            x = np.empty((count, d), dtype=dtype)
+            for k in range(d):
+                x[:, k] = local.raster.GetRasterBand(k + 1).ReadAsArray(*block)[t]
+            stats = gmmr.GMMStats()
+            stats.update(x, labels)
+            return stats
+        Y[start : start + count, 0] = labels
+
+        # Load the Variables
+        for k in range(d):
+            band = local.raster.GetRasterBand(k + 1).ReadAsArray(*block)
+            X[start : start + count, k] = band[t]
+
+    if inJobs > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(inJobs, len(jobs)))
+        results = pool.map(extract, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [extract(job) for job in jobs]
+    if inStats is not None:
+        for stats in results:
+            inStats.merge(stats)
+
+    # Clean/Close variables
+    roiBand = None
+    local = None
+    roi = None  # Close the roi file
+    raster = None  # Close the raster file
+
+    return X, Y
+
+
+def get_folds(y, nFolds: int, inSeed: int = 0):
+    """!@brief Stratified random folds for cross validation.
+
+    Samples of each class are drawn at random in nFolds parts of the same size (one sample
+    more for some of them), like a shuffled StratifiedKFold.
+        Input:
+            y: the labels of the samples
+            nFolds: number of folds (int)
+            inSeed: seed of the random draw (int)
+        Output:
+            fold: the fold of each sample, from 0 to nFolds - 1 (int array)
+    """
+    y = np.asarray(y).ravel()
+    rs = np.random.RandomState(inSeed)
+    fold = np.empty(y.size, dtype=np.int64)
+    for c in np.unique(y):
+        t = np.where(y == c)[0]
+        fold[t] = rs.permutation(t.size) * nFolds // t.size
+    return fold
+
+
+def get_scaling(M, m):
+    """!@brief Factor and offset scaling samples between -1 and 1.
+
+    Constant variables are not scaled, as in trainingSet.scale.
+        Input:
+            M: maximum of each variable
+            m: minimum of each variable
+        Output:
+            a, b: factor and offset of each variable, xs = x * a + b (float arrays)
+    """
+    M = np.asarray(M, dtype=np.float64)
+    m = np.asarray(m, dtype=np.float64)
+    den = M - m
+    ok = den != 0
+    a, b = np.ones(M.size), np.zeros(M.size)
+    a[ok] = 2 / den[ok]
+    b[ok] = -2 * m[ok] / den[ok] - 1
+    return a, b
+
+
+class trainingSet:
+    """!@brief Training samples, stored once with the data type of the image.
+
+    Subsets (train/test split, cross validation folds) are arrays of indices. The scaled samples
+    of a subset are only computed when a classifier needs them, with the scaling parameters of
+    the whole set.
+
+    Input :
+        X : the sample matrix, one line per pixel (n x d array)
+        Y : the labels of the pixels (n or n x 1 array)
+    """
+
+    def __init__(self, X, Y):
+        self.X = X
+        self.Y = np.asarray(Y).ravel()
+        self.M = np.amax(X, axis=0).astype(np.float64)
+        self.m = np.amin(X, axis=0).astype(np.float64)
+
+    def get_index(self):
+        """!@brief Indices of all the samples"""
+        return np.arange(self.Y.size)
+
+    def split(self, inSplit: float, inSeed: int = 0):
+        """!@brief Stratified random split of the samples.
+
+        The random draws are the ones of the former concatenation code of learnModel, so a
+        seed gives the same subsets.
+            Input:
+                inSplit: proportion of the pixels of each class used for training (float)
+                inSeed: seed of the random selection (int)
+            Output:
+                train: indices of the training samples
+                test: indices of the testing samples
+        """
+        rs = np.random.RandomState(inSeed)
+        train, test = [], []
+        for i in range(int(self.Y.max())):
+            t = np.where((i + 1) == self.Y)[0]
+            ns = int(t.size * inSplit)
+            rp = rs.permutation(t.size)
+            train.insert(0, t[rp[0:ns]])
+            test.insert(0, t[rp[ns:]])
+        return np.concatenate(train), np.concatenate(test)
+
+    def folds(self, nFolds: int, inIndex=None, inSeed: int = 0):
+        """!@brief Stratified random folds for cross validation.
+
+        The samples of each class are drawn at random in the folds, see get_folds.
+            Input:
+                nFolds: number of folds (int)
+                inIndex: indices of the samples to cut, all of them if None
+                inSeed: seed of the random draw (int)
+            Output:
+                fold: the fold of each sample of inIndex (int array)
+        """
+        if inIndex is None:
+            inIndex = self.get_index()
+        return get_folds(self.Y[inIndex], nFolds, inSeed)
+
+    def scale(self, x):
+        """!@brief Scale samples between -1 and 1 with the parameters of the whole set.
+
+        Input:
+            x: samples (n x d array)
+        Output:
+            xs: scaled samples (n x d float array)
+        """
+        den = self.M - self.m
+        ok = den != 0
+        xs = x.astype(np.float64)
+        xs[:, ok] = 2 * (xs[:, ok] - self.m[ok]) / den[ok] - 1
+        return xs
+
+    def get(self, inIndex=None):
+        """!@brief Scaled samples and labels of a subset.
+
+        Input:
+            inIndex: indices of the samples, all of them if None
+        Output:
+            x: scaled samples (float array)
+            y: labels
+        """
+        if inIndex is None:
+            return self.scale(self.X), self.Y
+        return self.scale(self.X[inIndex]), self.Y[inIndex]
+
+    def get_unique(self, inIndex=None):
+        """!@brief Distinct (sample, label) rows of a subset, scaled, with their number.
+
+        Scanned maps have few colours, so training on the distinct rows weighted by their
+        number is much cheaper. Small unsigned rows (8 bits RGB + label) are packed in one
+        integer to find them.
+            Input:
+                inIndex: indices of the samples, all of them if None
+            Output:
+                x: scaled distinct samples (float array)
+                y: labels of the distinct samples
+                counts: number of samples of the subset equal to each row
+                inverse: row of each sample of the subset
+        """
+        if inIndex is None:
+            inIndex = self.get_index()
+        X, Y = self.X[inIndex], self.Y[inIndex]
+        d = X.shape[1]
+        bits = 8 * X.dtype.itemsize
+        if X.dtype.kind == "u" and Y.dtype.kind == "u" and bits * (d + 1) <= 64:
+            key = Y.astype(np.uint64) << np.uint64(bits * d)
+            for k in range(d):
+                key |= X[:, k].astype(np.uint64) << np.uint64(bits * k)
+            _, first, inverse, counts = np.unique(
+                key, return_index=True, return_inverse=True, return_counts=True
+            )
         else:
-            lines = nl - i
-        for j in range(0, nc, x_block_size):  # Check for size consistency in X
-            if j + x_block_size < nc:
-                cols = x_block_size
-            else:
-                cols = nc - j
+            rows = np.column_stack((X, Y)).astype(np.float64)
+            _, first, inverse, counts = np.unique(
+                rows, axis=0, return_index=True, return_inverse=True, return_counts=True
+            )
+        return self.scale(X[first]), Y[first], counts, inverse.ravel()
+
+    def get_unique_folds(self, nFolds: int, inIndex=None, inSeed: int = 0):
+        """!@brief Distinct (sample, label) rows of each cross validation fold of a subset.
+
+        The pixels are cut in folds (see get_folds) before the distinct rows of each fold are
+        found, so a colour covering many pixels is in every fold, weighted by the number of
+        its pixels there. Learning and scoring with these weights is the same as with the
+        pixels of the folds.
+            Input:
+                nFolds: number of folds (int)
+                inIndex: indices of the samples, all of them if None
+                inSeed: seed of the random draw of the folds (int)
+            Output:
+                x: scaled distinct samples of the folds (float array)
+                y: their labels
+                counts: number of pixels of the fold equal to each row
+                fold: the fold of each row (int array)
+        """
+        if inIndex is None:
+            inIndex = self.get_index()
+        x, y, _, inverse = self.get_unique(inIndex)
+        fold = self.folds(nFolds, inIndex, inSeed)
+        key, counts = np.unique(
+            inverse.astype(np.int64) * nFolds + fold, return_counts=True
+        )
+        rows = key // nFolds
+        return x[rows], y[rows], counts, key % nFolds
+
+
+def get_samples_manifest(inRaster: str, inVector: str, inField: str, inOptions=None):
+    """!@brief Description of the samples of a raster under a vector, and its key.
+
+    The modification time and size of the raster, the vector and the files of a shapefile
+    (.dbf, .shx, .prj, .cpg) are part of it, so editing the vector or its attributes changes it.
+        Input:
+            inRaster: the name of the raster
+            inVector: the name of the vector
+            inField: the field of the vector with the labels
+            inOptions: other settings of the extraction (dict)
+        Output:
+            key: hash of the manifest (str)
+            manifest: the description (dict)
+    """
+    files = [inRaster, inVector]
+    root, ext = os.path.splitext(inVector)
+    if ext.lower() == ".shp":
+        files += [root + sidecar for sidecar in (".dbf", ".shx", ".prj", ".cpg")]
+    manifest = {
+        "raster": os.path.abspath(inRaster),
+        "vector": os.path.abspath(inVector),
+        "field": inField,
+        "options": inOptions,
+        "files": {
+            os.path.abspath(name): [os.stat(name).st_mtime_ns, os.stat(name).st_size]
+            for name in files
+            if os.path.exists(name)
+        },
+    }
+    key = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return key, manifest
+
+
+def get_samples_cache_name(key: str, inFolder=None):
+    """!@brief Name of the cache files of some samples, without extension"""
+    if inFolder is None:
+        inFolder = os.path.join(tempfile.gettempdir(), "historical_map_samples")
+    return os.path.join(inFolder, key)
+
+
+def load_samples_cache(
+    inRaster: str, inVector: str, inField: str, inOptions=None, inFolder=None
+):
+    """!@brief Load the samples saved by save_samples_cache, if they are still valid.
 
-            # Load the reference data
+    Input:
+        inRaster: the name of the raster
+        inVector: the name of the vector
+        inField: the field of the vector with the labels
+        inOptions: other settings of the extraction (dict)
+        inFolder: folder of the cache, default is in the temp folder
+    Output:
+        X: the sample matrix, None if it is not in the cache
+        Y: the label of the pixels, None if it is not in the cache
+    """
+    key, manifest = get_samples_manifest(inRaster, inVector, inField, inOptions)
+    name = get_samples_cache_name(key, inFolder)
+    # The manifest is written last, the samples are complete if it exists
+    if not os.path.exists(name + ".json"):
+        return None, None
+    with np.load(name + ".npz") as samples:
+        return samples["X"], samples["Y"]
+
+
+def save_samples_cache(
+    X, Y, inRaster: str, inVector: str, inField: str, inOptions=None, inFolder=None
+):
+    """!@brief Save samples (compressed .npz) with a manifest describing where they come from.
+
+    The samples saved before for the same raster, vector and field are deleted: they are the
+    ones of an earlier state of the files or of other options, so the cache keeps one entry per
+    training set instead of one per edit.
+    Input:
+        X: the sample matrix
+        Y: the label of the pixels
+        inRaster: the name of the raster
+        inVector: the name of the vector
+        inField: the field of the vector with the labels
+        inOptions: other settings of the extraction (dict)
+        inFolder: folder of the cache, default is in the temp folder
+    Output:
+        name: the name of the cache files, without extension
+    """
+    key, manifest = get_samples_manifest(inRaster, inVector, inField, inOptions)
+    name = get_samples_cache_name(key, inFolder)
+    folder = os.path.dirname(name)
+    os.makedirs(folder, exist_ok=True)
+    for other in glob.glob(os.path.join(folder, "*.json")):
+        other = os.path.splitext(other)[0]
+        try:
+            with open(other + ".json") as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if other != name and all(
+            old.get(k) == manifest[k] for k in ("raster", "vector", "field")
+        ):
+            # The manifest first, the samples are not valid without it
+            for ext in (".json", ".npz"):
+                if os.path.exists(other + ext):
+                    os.remove(other + ext)
+    np.savez_compressed(name + ".npz", X=X, Y=Y)
+    manifest["samples"] = [int(X.shape[0]), int(X.shape[1]), X.dtype.name]
+    with open(name + ".json", "w") as f:
+        json.dump(manifest, f, indent=1)
+    return name
 
-            ROI = roi.GetRasterBand(1).ReadAsArray(j, i, cols, lines)
 
-            t = np.nonzero(ROI)
+def get_image_colours(raster_name: str):
+    """!@brief Colours used by an image of at most 3 bands of 8 bits, read per block.
 
-            if t[0].size > 0:
-                Y = np.concatenate(
-                    (Y, ROI[t].reshape((t[0].shape[0], 1)).astype("uint8"))
-                )
-                # Load the Variables
-                Xtp = np.empty((t[0].shape[0], d))
-                for k in range(d):
-                    band = raster.GetRasterBand(k + 1).ReadAsArray(j, i, cols, lines)
-                    Xtp[:, k] = band[t]
-                # try:
-                X = np.concatenate((X, Xtp))
-                # except MemoryError:
-                #     print("Impossible to allocate memory: ROI too big")
-                #     exit()
+    Input:
+        raster_name: the name of the raster file
+    Output:
+        colours: indices of the colours of the image (see get_colour_table)
+    """
+    raster = gdal.Open(raster_name, gdal.GA_ReadOnly)
+    d = raster.RasterCount
+    nc = raster.RasterXSize
+    nl = raster.RasterYSize
+    x_block_size, y_block_size = raster.GetRasterBand(1).GetBlockSize()
 
-    # Clean/Close variables
-    del Xtp, band
-    roi = None  # Close the roi file
-    raster = None  # Close the raster file
+    used = np.zeros(256**d, dtype=bool)
+    for i in range(0, nl, y_block_size):
+        lines = min(y_block_size, nl - i)
+        for j in range(0, nc, x_block_size):
+            cols = min(x_block_size, nc - j)
+            index = np.zeros(cols * lines, dtype=np.int64)
+            for k in range(d):
+                band = raster.GetRasterBand(k + 1).ReadAsArray(j, i, cols, lines)
+                index |= band.ravel().astype(np.int64) << (8 * k)
+            used[index] = True
 
-    return X, Y
+    raster = None
+    return np.nonzero(used)[0]
+
+
+def get_colour_table(predict, d: int, inColours=None):
+    """!@brief Label of the colours of an image of d 8-bit bands (d <= 3).
+
+    The colour of index i has the value (i >> 8k) & 255 in band k+1. The colours are predicted
+    by the model, so the table gives its labels exactly. Colours not predicted get the label 0,
+    the pixels of these colours must be predicted by the model.
+        Input:
+            predict: function giving the labels of colours (n x d float array)
+            d: number of bands (int)
+            inColours: indices of the colours to predict, all of them if None
+        Output:
+            table: label of each colour, 0 if not predicted (uint8 array of 256**d values)
+    """
+    shifts = 8 * np.arange(d)
+    if inColours is None:
+        inColours = np.arange(256**d)
+
+    table = np.zeros(256**d, dtype=np.uint8)
+    for i in range(0, inColours.size, 2**20):
+        index = inColours[i : i + 2**20]
+        colours = (index[:, None] >> shifts) & 255
+        table[index] = predict(colours.astype(np.float64))
+    return table
+
+
+def get_colour_keys(X, dtype):
+    """!@brief Pack the values of each pixel in one integer.
+
+    Input:
+        X: the pixels, one line per pixel, with the values of an integer data type
+        dtype: the integer data type of the image
+    Output:
+        keys: key of each pixel (uint64 array), None if its values do not fit in 64 bits
+    """
+    info = np.iinfo(dtype)
+    bits = info.bits
+    if bits * X.shape[1] > 64:
+        return None
+    keys = np.zeros(X.shape[0], dtype=np.uint64)
+    for k in range(X.shape[1]):
+        keys |= (X[:, k] - info.min).astype(np.uint64) << np.uint64(bits * k)
+    return keys
+
+
+class colourCache:
+    """!@brief Labels of the colours predicted last, by key (see get_colour_keys).
+
+    Keys are kept sorted so all the colours of a block are looked up at once. Beyond inSize
+    colours, the ones used the least recently are dropped.
+
+    Input :
+        inSize : maximum number of colours (int)
+    """
+
+    def __init__(self, inSize: int = 65536):
+        self.size = inSize
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.labels = np.empty(0, dtype=np.uint8)
+        self.used = np.empty(0, dtype=np.int64)
+        self.time = 0
+
+    def get(self, keys):
+        """!@brief Labels of sorted distinct keys.
+
+        Input:
+            keys: the keys to look up (sorted uint64 array)
+        Output:
+            labels: the label of each key, 0 if not found (uint8 array)
+            found: keys in the cache (bool array)
+        """
+        self.time += 1
+        labels = np.zeros(keys.size, dtype=np.uint8)
+        if self.keys.size == 0:
+            return labels, np.zeros(keys.size, dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        found = self.keys[pos] == keys
+        labels[found] = self.labels[pos[found]]
+        self.used[pos[found]] = self.time
+        return labels, found
+
+    def add(self, keys, labels):
+        """!@brief Add the labels of keys missing in the cache.
+
+        Input:
+            keys: the keys (uint64 array)
+            labels: the label of each key
+        """
+        keys = np.concatenate((self.keys, keys))
+        labels = np.concatenate((self.labels, labels.astype(np.uint8)))
+        used = np.concatenate(
+            (self.used, np.full(labels.size - self.used.size, self.time))
+        )
+        if keys.size > self.size:
+            keep = np.argsort(used, kind="stable")[-self.size :]
+            keys, labels, used = keys[keep], labels[keep], used[keep]
+        order = np.argsort(keys)
+        self.keys, self.labels, self.used = keys[order], labels[order], used[order]
 
 
 def predict_image(raster_name: str, classif_name: str, classifier, mask_name=None):
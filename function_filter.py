@@ -0,0 +1,419 @@
+#! /usr/bin/python3
+
+"""!@brief Filtering engine (grey closing then iterated median) working per tile"""
+
+from __future__ import annotations
+
+import threading
+
+import numpy as np
+from osgeo import gdal, gdal_array
+from scipy import ndimage
+
+# Each worker thread keeps its own handle on the opened images
+_local = threading.local()
+
+
+def get_halo(inShapeGrey: int, inShapeMedian: int, iterMedian: int) -> int:
+    """!@brief Number of pixels a tile must be extended by so that the filter chain is exact on it.
+
+    Each output pixel of the chain only depends on the input pixels within the reach of every
+    operation : the closing is a dilation followed by an erosion (inShapeGrey//2 each) and each
+    median pass adds inShapeMedian//2.
+        Input:
+            inShapeGrey : size of the closing filter (int)
+            inShapeMedian : size of the median filter (int)
+            iterMedian : number of median iterations (int)
+        Output:
+            halo : margin in pixels (int)
+    """
+    return 2 * (inShapeGrey // 2) + iterMedian * (inShapeMedian // 2)
+
+
+def scale_size(size: int, factor: float) -> int:
+    """!@brief Size of a filter on an image whose pixels are factor times bigger.
+
+    The size is rounded to the nearest odd number so the filter stays centered.
+        Input:
+            size : size of the filter at full resolution (int)
+            factor : size of the new pixels in full resolution pixels (float)
+        Output:
+            size : size of the filter at the new resolution, at least 1 (int)
+    """
+    return max(1, 2 * int(round((size / factor - 1) / 2)) + 1)
+
+
+def get_tiles(nl: int, nc: int, tileSize: int, halo: int, inWindow=None):
+    """!@brief Generate the tiles of an image and the windows to read for each of them.
+
+    Windows are the tiles extended by halo pixels, clipped to the image, so that the border
+    of the image is handled exactly like when the whole band is filtered.
+        Input:
+            nl : number of lines of the image (int)
+            nc : number of columns of the image (int)
+            tileSize : size of the tiles (int)
+            halo : margin added around each tile (int)
+            inWindow : only tile this (xoff, yoff, xsize, ysize) part of the image (optional)
+        Output:
+            generator of (window, tile), both as (xoff, yoff, xsize, ysize) tuples
+    """
+    if inWindow is None:
+        inWindow = (0, 0, nc, nl)
+    xoff, yoff, xsize, ysize = inWindow
+    for i in range(yoff, yoff + ysize, tileSize):
+        if i + tileSize < yoff + ysize:  # Check for size consistency in Y
+            lines = tileSize
+        else:
+            lines = yoff + ysize - i
+        i0, i1 = max(i - halo, 0), min(i + lines + halo, nl)
+        for j in range(xoff, xoff + xsize, tileSize):  # Check for size consistency in X
+            if j + tileSize < xoff + xsize:
+                cols = tileSize
+            else:
+                cols = xoff + xsize - j
+            j0, j1 = max(j - halo, 0), min(j + cols + halo, nc)
+            yield (j0, i0, j1 - j0, i1 - i0), (j, i, cols, lines)
+
+
+def get_interior(temp, window, tile):
+    """!@brief Extract the tile from the array filtered on its window."""
+    x = tile[0] - window[0]
+    y = tile[1] - window[1]
+    return temp[y : y + tile[3], x : x + tile[2]]
+
+
+def grey_closing_separable(temp, size: int, output=None):
+    """!@brief Grey closing with a size x size square, as running max then running min per axis.
+
+    A flat rectangle is separable : the dilation (resp. erosion) is a 1D running max (resp.
+    min) along the lines then along the columns, and ndimage computes these in constant time
+    per pixel whatever the size (van Herk/Gil-Werman like). The four passes are done in place
+    in output, so no intermediate array is allocated.
+
+    Result is identical to ndimage.grey_closing(temp, size=(size, size)).
+        Input:
+            temp : the array to filter (2D)
+            size : size of the closing filter (int)
+            output : array where to store the result, same shape as temp (optional)
+        Output:
+            output : the closed array
+    """
+    if output is None:
+        output = np.empty_like(temp)
+
+    # ndimage shifts the dilation window by one pixel for even sizes
+    if size % 2:
+        origin = 0
+    else:
+        origin = -1
+    ndimage.maximum_filter1d(temp, size, axis=0, output=output, origin=origin)
+    ndimage.maximum_filter1d(output, size, axis=1, output=output, origin=origin)
+    ndimage.minimum_filter1d(output, size, axis=0, output=output)
+    ndimage.minimum_filter1d(output, size, axis=1, output=output)
+    return output
+
+
+def median_filter_histogram(
+    temp, size: int, output=None, stripSize: int = 256, maxLevels: int = 256
+):
+    """!@brief Median filter whose cost per pixel does not depend on the size of the filter.
+
+    The median of a window is the number of grey levels t for which the window holds at most
+    rank pixels lower or equal to t. For each level, this count is a box sum of the
+    thresholded image, computed with integral images in constant time per pixel. Eight levels
+    (four for windows of 256 pixels or more) are packed in the lanes of an uint64 so one box
+    sum gives all of them : the lanes never overflow since a count is below the window size,
+    and prefix sums are allowed to wrap around. The cost grows with the number of grey levels
+    of the array, so it is meant for 8 bits images : arrays with more than maxLevels grey
+    levels are filtered by ndimage.
+
+    Result is identical to ndimage.median_filter(temp, size=(size, size)).
+        Input:
+            temp : the array to filter (2D, integer)
+            size : size of the median filter (int)
+            output : array where to store the result, same shape as temp (optional)
+            stripSize : number of lines processed at once, bounds memory use (int)
+            maxLevels : maximal number of grey levels of the array (int)
+        Output:
+            output : the filtered array
+    """
+    nl, nc = temp.shape
+    k = size
+    if output is None:
+        output = np.empty_like(temp)
+    if k == 1 or k > min(nl, nc):
+        return ndimage.median_filter(temp, size=(k, k), output=output)
+
+    # Work on the rank of the grey levels, LUT below are then as small as possible
+    levels, inverse = np.unique(temp, return_inverse=True)
+    if levels.size == 1:
+        output[...] = temp
+        return output
+    if levels.size > maxLevels:
+        return ndimage.median_filter(temp, size=(k, k), output=output)
+    if levels.size <= 256:
+        inverse = inverse.astype(np.uint8)
+    else:
+        inverse = inverse.astype(np.uint32)
+    inverse = inverse.reshape(nl, nc)
+
+    # Same border as ndimage 'reflect' mode, and same window position for even sizes
+    before, after = k // 2, (k - 1) // 2
+    padded = np.pad(inverse, ((before, after), (before, after)), mode="symmetric")
+    inverse = None
+    rank = (k * k) // 2
+
+    if k * k < 256:
+        lanes, laneType = 8, np.uint8
+    else:
+        lanes, laneType = 4, np.uint16
+    shift = 64 // lanes
+
+    # For each group of levels, a LUT gives the packed thresholded values of each level
+    values = np.arange(levels.size)
+    luts = []
+    for g in range(0, levels.size - 1, lanes):
+        lut = np.zeros(levels.size, dtype=np.uint64)
+        for l, t in enumerate(range(g, min(g + lanes, levels.size - 1))):
+            lut |= (values <= t).astype(np.uint64) << np.uint64(shift * l)
+        luts.append((lut, min(lanes, levels.size - 1 - g)))
+
+    idx = np.empty((nl, nc), dtype=np.uint32)
+    for i in range(0, nl, stripSize):
+        lines = min(stripSize, nl - i)
+        strip = padded[i : i + lines + k - 1]
+        cols = np.empty((lines, nc + k - 1), dtype=np.uint64)
+        box = np.empty((lines, nc), dtype=np.uint64)
+        idx[i : i + lines] = 0
+        for lut, n in luts:
+            # Box sums along the columns then along the lines
+            cumul = np.cumsum(lut[strip], axis=0, dtype=np.uint64)
+            cols[0] = cumul[k - 1]
+            np.subtract(cumul[k:], cumul[:-k], out=cols[1:])
+            cumul = np.cumsum(cols, axis=1, dtype=np.uint64)
+            box[:, 0] = cumul[:, k - 1]
+            np.subtract(cumul[:, k:], cumul[:, :-k], out=box[:, 1:])
+
+            # Count the levels under the median
+            counts = box.view(laneType).reshape(lines, nc, lanes)[..., :n]
+            below = np.sum(counts <= rank, axis=-1, dtype=np.uint32)
+            if not below.any():
+                break
+            idx[i : i + lines] += below
+
+    return np.take(levels, idx, out=output)
+
+
+def median_filter(temp, size: int, output=None, inMedian="auto"):
+    """!@brief Median filter of a 2D array with the chosen engine.
+
+    Input:
+        temp : the array to filter
+        size : size of the median filter (int)
+        output : array where to store the result, same shape as temp (optional)
+        inMedian : median engine, 'scipy', 'histogram' (8 bits) or 'auto' (str)
+    Output:
+        output : the filtered array
+    """
+    if inMedian == "auto":
+        # histogram engine is faster from 7x7 windows on 8 bits images
+        if temp.dtype == np.uint8 and size >= 7:
+            inMedian = "histogram"
+        else:
+            inMedian = "scipy"
+    if inMedian == "histogram" and temp.dtype in (np.uint8, np.uint16):
+        return median_filter_histogram(temp, size, output=output)
+    return ndimage.median_filter(temp, size=(size, size), output=output)
+
+
+def grey_closing(temp, size: int, output=None, inClosing="separable"):
+    """!@brief Grey closing of a 2D array with a size x size square and the chosen engine.
+
+    Input:
+        temp : the array to filter
+        size : size of the closing filter (int)
+        output : array where to store the result, same shape as temp (optional)
+        inClosing : closing engine, 'separable' or 'scipy' (str)
+    Output:
+        output : the closed array
+    """
+    if inClosing == "separable":
+        return grey_closing_separable(temp, size, output=output)
+    return ndimage.grey_closing(temp, size=(size, size), output=output)
+
+
+class filterChain:
+    """!@brief Grey closing then iterated median filter, applied tile after tile.
+
+    The tile is read in a first buffer, the closing is written in a second one, then the median
+    iterations go back and forth between the second and the third one, and stop as soon as an
+    iteration does not change any pixel : the tile is then a root signal of the median filter
+    and next iterations would give the same result. Buffers are flat arrays
+    allocated for the biggest tile and shared by all the tiles and bands (a contiguous view of
+    the right shape is taken for each tile), so memory stays the same during the filtering.
+
+    Input:
+        inShapeGrey : size of the closing filter (int)
+        inShapeMedian : size of the median filter (int)
+        iterMedian : number of median iterations (int)
+        inMedian : median engine, 'scipy', 'histogram' (8 bits) or 'auto' (str)
+        inClosing : closing engine, 'separable' or 'scipy' (str)
+    """
+
+    def __init__(
+        self,
+        inShapeGrey: int,
+        inShapeMedian: int,
+        iterMedian: int,
+        inMedian="auto",
+        inClosing="separable",
+    ):
+        self.params = (inShapeGrey, inShapeMedian, iterMedian, inMedian, inClosing)
+        self.buffers = [np.empty(0), np.empty(0), np.empty(0), np.empty(0)]
+        self.changes = []
+
+    def get_buffer(self, i: int, shape, dtype):
+        """!@brief Get buffer i as a contiguous array of the given shape, growing it if needed."""
+        size = shape[0] * shape[1]
+        if self.buffers[i].dtype != dtype or self.buffers[i].size < size:
+            self.buffers[i] = np.empty(size, dtype=dtype)
+        return self.buffers[i][:size].reshape(shape)
+
+    def read(self, band, window):
+        """!@brief Read the window (xoff, yoff, xsize, ysize) of a GDAL band in the first buffer."""
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+        temp = self.get_buffer(0, (window[3], window[2]), dtype)
+        return band.ReadAsArray(*window, buf_obj=temp)
+
+    def run(self, temp):
+        """!@brief Filter an array, result is a view of one of the buffers.
+
+        The number of pixels changed by each median iteration is saved in self.changes.
+            Input:
+                temp : the array to filter
+            Output:
+                temp : the filtered array
+        """
+        inShapeGrey, inShapeMedian, iterMedian, inMedian, inClosing = self.params
+        ping = self.get_buffer(1, temp.shape, temp.dtype)
+        pong = self.get_buffer(2, temp.shape, temp.dtype)
+        changed = self.get_buffer(3, temp.shape, np.bool_)
+        self.changes = []
+
+        grey_closing(temp, inShapeGrey, output=ping, inClosing=inClosing)
+        for j in range(iterMedian):
+            median_filter(ping, inShapeMedian, output=pong, inMedian=inMedian)
+            np.not_equal(ping, pong, out=changed)
+            self.changes.append(int(np.count_nonzero(changed)))
+            ping, pong = pong, ping
+            if self.changes[-1] == 0:
+                break
+        return ping
+
+
+def filter_array(
+    temp,
+    inShapeGrey: int,
+    inShapeMedian: int,
+    iterMedian: int,
+    inMedian="auto",
+    inClosing="separable",
+):
+    """!@brief Filter an array with grey closing, then with iterated median filter.
+
+    Input:
+        temp : the array to filter
+        inShapeGrey : size of the closing filter (int)
+        inShapeMedian : size of the median filter (int)
+        iterMedian : number of median iterations (int)
+        inMedian : median engine, 'scipy', 'histogram' (8 bits) or 'auto' (str)
+        inClosing : closing engine, 'separable' or 'scipy' (str)
+    Output:
+        temp : the filtered array
+    """
+    chain = filterChain(inShapeGrey, inShapeMedian, iterMedian, inMedian, inClosing)
+    return chain.run(temp)
+
+
+def sweep_array(
+    temp, listGrey, listMedian, listIter, inMedian="auto", inClosing="separable"
+):
+    """!@brief Filter an array with every combination of a grid of parameters.
+
+    Work is shared between the combinations : the closing is computed once per size and used
+    for all the median settings, and iteration k of the median filter is the starting point of
+    iteration k+1. Iterations stop when the median filter does not change anything anymore.
+        Input:
+            temp : the array to filter
+            listGrey : sizes of the closing filter (list of int)
+            listMedian : sizes of the median filter (list of int)
+            listIter : numbers of median iterations (list of int)
+            inMedian : median engine, 'scipy', 'histogram' (8 bits) or 'auto' (str)
+            inClosing : closing engine, 'separable' or 'scipy' (str)
+        Output:
+            generator of ((inShapeGrey, inShapeMedian, iterMedian), filtered array), the arrays
+            are reused by the next combinations
+    """
+    closed = np.empty_like(temp)
+    ping = np.empty_like(temp)
+    pong = np.empty_like(temp)
+    for inShapeGrey in listGrey:
+        grey_closing(temp, inShapeGrey, output=closed, inClosing=inClosing)
+        for inShapeMedian in listMedian:
+            src = closed
+            converged = False
+            if 0 in listIter:
+                yield (inShapeGrey, inShapeMedian, 0), src
+            for iterMedian in range(1, max(listIter) + 1):
+                if not converged:
+                    if src is ping:
+                        dst = pong
+                    else:
+                        dst = ping
+                    median_filter(src, inShapeMedian, output=dst, inMedian=inMedian)
+                    converged = np.array_equal(src, dst)
+                    src = dst
+                if iterMedian in listIter:
+                    yield (inShapeGrey, inShapeMedian, iterMedian), src
+
+
+def open_band(inImage: str, i: int):
+    """!@brief Get the band i (from 0) of an image, opened once per worker.
+
+    GDAL datasets cannot be shared between threads, so each worker opens its own handle.
+    """
+    datasets = getattr(_local, "datasets", None)
+    if datasets is None:
+        datasets = _local.datasets = {}
+    if inImage not in datasets:
+        datasets[inImage] = gdal.Open(inImage, gdal.GA_ReadOnly)
+    return datasets[inImage].GetRasterBand(i + 1)
+
+
+def close_datasets():
+    """!@brief Close the images opened by open_band and free the buffers of the current worker."""
+    _local.datasets = None
+    _local.chain = None
+
+
+def filter_tile(job):
+    """!@brief Read, filter and crop one tile of one band, used as work unit by historicalFilter.
+
+    Input:
+        job : (inImage, i, window, tile, params) tuple, params being the arguments of
+            filterChain
+    Output:
+        i : the band index (int)
+        tile : the tile (xoff, yoff, xsize, ysize) where to write the result
+        temp : the filtered tile
+        changes : number of pixels changed by each median iteration (list of int)
+    """
+    inImage, i, window, tile, params = job
+    chain = getattr(_local, "chain", None)
+    if chain is None or chain.params != params:
+        chain = _local.chain = filterChain(*params)
+
+    temp = chain.read(open_band(inImage, i), window)
+    temp = chain.run(temp)
+    # Copy the tile, as the buffers are used again by the next work unit of this worker
+    return i, tile, get_interior(temp, window, tile).copy(), chain.changes
@@ -24,12 +24,14 @@
 
 from __future__ import annotations
 
+import hashlib
 import os
 import pickle
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, gdal_array, ogr, osr
 from qgis.core import Qgis, QgsMessageLog
 
 from qgis.PyQt import QtCore
@@ -39,6 +41,7 @@ from scipy import ndimage
 
 import HistoricalMap.accuracy_index as ai
 import HistoricalMap.function_dataraster as dataraster
+import HistoricalMap.function_filter as ffilter
 import HistoricalMap.gmm_ridge as gmmr
 
 
@@ -52,12 +55,51 @@ class historicalFilter:
         outName : outname name of the filtered file (str)
         inShapeGrey : Size for the grey closing convolution matrix (odd number, int)
         inShapeMedian : Size for the median convolution matrix (odd  number, int)
+        iterMedian : Number of median filter iterations (int)
+        inTileSize : Size of the tiles processed one at a time, None to filter whole bands (int)
+        inJobs : Number of tiles filtered in parallel threads (int)
+        inMedian : Median engine, 'scipy', 'histogram' (8 bits images) or 'auto' (str)
+        inClosing : Closing engine, 'separable' (running max/min per axis) or 'scipy' (str)
+        inResolution : Ground resolution of the filtered file, None to keep the image one (float).
+            The image is averaged to this resolution first and the filter sizes, given in pixels
+            of the image, are reduced accordingly.
+        inMask : Mask of the map (see dataraster.get_map_mask), tiles outside it are skipped and
+            pixels outside it are set to 0 (str)
 
     Output :
         Nothing except a raster file (outName)
     """
 
-    def __init__(self, inImage, outName, inShapeGrey, inShapeMedian, iterMedian):
+    def __init__(
+        self,
+        inImage,
+        outName,
+        inShapeGrey,
+        inShapeMedian,
+        iterMedian,
+        inTileSize=1024,
+        inJobs=1,
+        inMedian="auto",
+        inClosing="separable",
+        inResolution=None,
+        inMask=None,
+    ):
+        # Resample once, every next step works on the filtered file at this resolution
+        temp_folder, rasterTemp = None, None
+        if inResolution:
+            temp_folder = tempfile.mkdtemp()
+            rasterTemp = os.path.join(temp_folder, "resampled.tif")
+            inImage, factor = dataraster.resample_image(
+                inImage, rasterTemp, inResolution
+            )
+        if inResolution and factor > 1:
+            inShapeGrey = ffilter.scale_size(inShapeGrey, factor)
+            inShapeMedian = ffilter.scale_size(inShapeMedian, factor)
+            QgsMessageLog.logMessage(
+                f"Resampled by {factor:.2f}, closing size {inShapeGrey}, "
+                f"median size {inShapeMedian}"
+            )
+
         # open data with Gdal
         # try:
         data, im = dataraster.open_data_band(inImage)
@@ -68,9 +110,29 @@ class historicalFilter:
         proj = data.GetProjection()
         geo = data.GetGeoTransform()
         d = data.RasterCount
+        nc = data.RasterXSize
+        nl = data.RasterYSize
+
+        # Tiles are extended by a halo so the result is the same as filtering the whole band
+        if inTileSize is None:
+            inTileSize = max(nl, nc)
+        halo = ffilter.get_halo(inShapeGrey, inShapeMedian, iterMedian)
+        tiles = list(ffilter.get_tiles(nl, nc, inTileSize, halo))
+        if inMask is not None:
+            maskData = gdal.Open(inMask, gdal.GA_ReadOnly)
+            maskBand = maskData.GetRasterBand(1)
+            nTiles = len(tiles)
+            tiles = [
+                (window, tile)
+                for window, tile in tiles
+                if dataraster.read_mask(maskBand, tile, nl, nc).any()
+            ]
+            QgsMessageLog.logMessage(
+                f"{nTiles - len(tiles)}/{nTiles} tiles outside the map are skipped"
+            )
 
         # Progress Bar
-        maxStep = d + d * iterMedian
+        maxStep = d * len(tiles)
         # try:
         filterProgress = progressBar(" Filtering...", maxStep)
         # except:
@@ -82,53 +144,250 @@ class historicalFilter:
 
         # try:
         outFile = dataraster.create_empty_tiff(outName, im, d, geo, proj)
+        im = None
         # except:
         #     print(f"Cannot write empty image {outName}")
 
-        # fill outFile with filtered band
-        for i in range(d):
-            # Read data from the right band
-            # try:
-            filterProgress.addStep()
-            temp = data.GetRasterBand(i + 1).ReadAsArray()
-            # except:
-            #     print(f"Cannot get rasterband{i}")
-            #     QgsMessageLog.logMessage(
-            #         "Problem reading band " + str(i) + " from image " + inImage
-            #     )
-            # Filter with greyclosing, then with median filter
-            # try:
-            temp = ndimage.morphology.grey_closing(
-                temp, size=(inShapeGrey, inShapeGrey)
-            )
-            # except:
-            #     print("Cannot filter with Grey_Closing")
-            #     QgsMessageLog.logMessage("Problem with Grey Closing")
-
-            for j in range(iterMedian):
+        # fill outFile with filtered band, each (band, tile) is a work unit
+        params = (inShapeGrey, inShapeMedian, iterMedian, inMedian, inClosing)
+        jobs = [
+            (inImage, i, window, tile, params)
+            for i in range(d)
+            for window, tile in tiles
+        ]
+        data = None
+        pool = None
+        if inJobs > 1:
+            # Threads, forking Qgis would copy the locks its render threads hold in GDAL; the
+            # filters spend their time in numpy, scipy and GDAL, which release the GIL
+            pool = ThreadPool(inJobs)
+            results = pool.imap(ffilter.filter_tile, jobs)
+        else:
+            results = map(ffilter.filter_tile, jobs)
+
+        try:
+            # Results come back in order and are saved by this single writer
+            # Median iterations stop on tiles that do not change anymore, keep track of it
+            changes = np.zeros((d, iterMedian), dtype=np.int64)
+            converged = np.zeros(d, dtype=int)
+            for i, tile, temp, tileChanges in results:
                 # try:
                 filterProgress.addStep()
-                temp = ndimage.filters.median_filter(
-                    temp, size=(inShapeMedian, inShapeMedian)
-                )
+                out = outFile.GetRasterBand(i + 1)
+                if inMask is not None:
+                    temp[~dataraster.read_mask(maskBand, tile, nl, nc)] = 0
+                out.WriteArray(temp, tile[0], tile[1])
+                temp = None
                 # except:
-                #     print("Cannot filter with Median")
-                #     QgsMessageLog.logMessage("Problem with median filter")
+                #     QgsMessageLog.logMessage(f"Cannot save band{i} on image {outName}")
+                changes[i, : len(tileChanges)] += tileChanges
+                if len(tileChanges) < iterMedian:
+                    converged[i] += 1
+            outFile.FlushCache()
+
+            for i in range(d):
+                QgsMessageLog.logMessage(
+                    f"Band {i + 1} : changed pixels per median iteration "
+                    f"{changes[i].tolist()}, {converged[i]}/{len(tiles)} tiles stopped early"
+                )
+            outFile = None
+        finally:
+            if pool is None:
+                ffilter.close_datasets()
+            else:
+                # All the results are read, unless an error stops the loop
+                pool.terminate()
+                pool.join()
 
-            # Save bandand outFile
-            # try:
-            out = outFile.GetRasterBand(i + 1)
-            out.WriteArray(temp)
-            out.FlushCache()
-            temp = None
-            # except:
-            #     QgsMessageLog.logMessage(f"Cannot save band{i} on image {outName}")
+        if temp_folder is not None:
+            if inImage == rasterTemp:
+                os.remove(rasterTemp)
+            os.rmdir(temp_folder)
 
         filterProgress.reset()
         # except:
         #     filterProgress.reset()
 
 
+class filterSweep:
+    """!@brief Filter a raster with every combination of a grid of filter parameters.
+
+    Help to choose the parameters of historicalFilter : the image is read once, the closing is
+    computed once per size and shared by all the median settings, and iteration k of the median
+    filter is reused for iteration k+1. One raster is saved per combination, named
+    outName_grey{size}_median{size}_iter{number}.tif.
+
+    Input :
+        inImage : image name to filter ('text.tif',str)
+        outName : outname name of the filtered files, parameters are added to it (str)
+        listGrey : Sizes for the grey closing convolution matrix (list of int)
+        listMedian : Sizes for the median convolution matrix (list of int)
+        listIter : Numbers of median filter iterations (list of int)
+        inWindow : Only filter this (xoff, yoff, xsize, ysize) window of the image (optional)
+        inTileSize : Size of the tiles processed one at a time (int)
+        inMedian : Median engine, 'scipy', 'histogram' (8 bits images) or 'auto' (str)
+        inClosing : Closing engine, 'separable' (running max/min per axis) or 'scipy' (str)
+
+    Output :
+        Nothing except a raster file per combination, their names are in self.outNames
+    """
+
+    def __init__(
+        self,
+        inImage,
+        outName,
+        listGrey,
+        listMedian,
+        listIter,
+        inWindow=None,
+        inTileSize=1024,
+        inMedian="auto",
+        inClosing="separable",
+    ):
+        data, im = dataraster.open_data_band(inImage)
+        proj = data.GetProjection()
+        geo = data.GetGeoTransform()
+        d = data.RasterCount
+        nc = data.RasterXSize
+        nl = data.RasterYSize
+        if inWindow is None:
+            inWindow = (0, 0, nc, nl)
+        xoff, yoff, xsize, ysize = inWindow
+
+        # Tiles are read once with the halo of the biggest parameters
+        halo = ffilter.get_halo(max(listGrey), max(listMedian), max(listIter))
+        tiles = list(ffilter.get_tiles(nl, nc, inTileSize, halo, inWindow))
+        filterProgress = progressBar(" Filtering...", d * len(tiles))
+
+        # Outputs start at the upper left corner of the window
+        geo = list(geo)
+        geo[0] = geo[0] + xoff * geo[1] + yoff * geo[2]
+        geo[3] = geo[3] + xoff * geo[4] + yoff * geo[5]
+        im = np.empty((ysize, xsize), dtype=im.dtype)
+        root, ext = os.path.splitext(outName)
+        self.outNames = []
+        outFiles = {}
+        for inShapeGrey in listGrey:
+            for inShapeMedian in listMedian:
+                for iterMedian in listIter:
+                    name = f"{root}_grey{inShapeGrey}_median{inShapeMedian}_iter{iterMedian}{ext}"
+                    outFiles[(inShapeGrey, inShapeMedian, iterMedian)] = (
+                        dataraster.create_empty_tiff(name, im, d, geo, proj)
+                    )
+                    self.outNames.append(name)
+
+        for i in range(d):
+            band = data.GetRasterBand(i + 1)
+            for window, tile in tiles:
+                filterProgress.addStep()
+                temp = band.ReadAsArray(*window)
+                for params, filtered in ffilter.sweep_array(
+                    temp, listGrey, listMedian, listIter, inMedian, inClosing
+                ):
+                    out = outFiles[params].GetRasterBand(i + 1)
+                    out.WriteArray(
+                        ffilter.get_interior(filtered, window, tile),
+                        tile[0] - xoff,
+                        tile[1] - yoff,
+                    )
+                temp = None
+
+        for outFile in outFiles.values():
+            outFile.FlushCache()
+        outFiles, data = None, None
+        filterProgress.reset()
+
+
+class filterPreview:
+    """!@brief Filter the part of a raster shown on screen, at screen resolution.
+
+    The window is read decimated by an integer factor so it fits in inBufSize pixels (GDAL uses
+    the overviews of the image if there are some), and the filter sizes are divided by the same
+    factor. It gives in a few seconds an idea of what historicalFilter would do on the window.
+
+    Input :
+        inImage : image name to filter ('text.tif',str)
+        outName : name of the preview raster (str)
+        inShapeGrey : Size for the grey closing convolution matrix at full resolution (int)
+        inShapeMedian : Size for the median convolution matrix at full resolution (int)
+        iterMedian : Number of median filter iterations (int)
+        inWindow : (xoff, yoff, xsize, ysize) window of the image to filter
+        inBufSize : (width, height) of the screen area showing the window, in pixels
+        inMedian : Median engine, 'scipy', 'histogram' (8 bits images) or 'auto' (str)
+        inClosing : Closing engine, 'separable' (running max/min per axis) or 'scipy' (str)
+
+    Output :
+        Nothing except a raster file (outName), the decimation factor is in self.factor
+    """
+
+    def __init__(
+        self,
+        inImage,
+        outName,
+        inShapeGrey,
+        inShapeMedian,
+        iterMedian,
+        inWindow,
+        inBufSize,
+        inMedian="auto",
+        inClosing="separable",
+    ):
+        data, im = dataraster.open_data_band(inImage)
+        proj = data.GetProjection()
+        geo = data.GetGeoTransform()
+        d = data.RasterCount
+        nc = data.RasterXSize
+        nl = data.RasterYSize
+        xoff, yoff, xsize, ysize = inWindow
+
+        # Integer factor so preview pixels stay aligned on the image pixels
+        factor = max(
+            1, min(xsize // max(1, inBufSize[0]), ysize // max(1, inBufSize[1]))
+        )
+        self.factor = factor
+        xsize, ysize = max(1, xsize // factor), max(1, ysize // factor)
+        if factor > 1:
+            inShapeGrey = ffilter.scale_size(inShapeGrey, factor)
+            inShapeMedian = ffilter.scale_size(inShapeMedian, factor)
+
+        # Read a halo around the window, so its borders look like in the full filter
+        halo = ffilter.get_halo(inShapeGrey, inShapeMedian, iterMedian)
+        left = min(halo, xoff // factor)
+        top = min(halo, yoff // factor)
+        right = max(0, min(halo, (nc - xoff) // factor - xsize))
+        bottom = max(0, min(halo, (nl - yoff) // factor - ysize))
+        window = (
+            xoff - left * factor,
+            yoff - top * factor,
+            (left + xsize + right) * factor,
+            (top + ysize + bottom) * factor,
+        )
+
+        geo = list(geo)
+        geo[0] = geo[0] + xoff * geo[1] + yoff * geo[2]
+        geo[3] = geo[3] + xoff * geo[4] + yoff * geo[5]
+        geo[1], geo[2] = geo[1] * factor, geo[2] * factor
+        geo[4], geo[5] = geo[4] * factor, geo[5] * factor
+        im = np.empty((ysize, xsize), dtype=im.dtype)
+        outFile = dataraster.create_empty_tiff(outName, im, d, geo, proj)
+
+        chain = ffilter.filterChain(
+            inShapeGrey, inShapeMedian, iterMedian, inMedian, inClosing
+        )
+        for i in range(d):
+            temp = data.GetRasterBand(i + 1).ReadAsArray(
+                *window,
+                buf_xsize=left + xsize + right,
+                buf_ysize=top + ysize + bottom,
+                resample_alg=gdal.GRIORA_Average,
+            )
+            temp = chain.run(temp)
+            out = outFile.GetRasterBand(i + 1)
+            out.WriteArray(temp[top : top + ysize, left : left + xsize])
+        outFile.FlushCache()
+        outFile, data = None, None
+
+
 class learnModel:
     """!@brief Learn model with a shp file and a raster image.
 
@@ -141,6 +400,18 @@ class learnModel:
         outModel : Name of the model to save, will be compulsory for the 3rd step (classifying).
         outMatrix : Default the name of the file inRaster(minus the extension)_inClassifier_inSeed_confu.csv (str).
         inClassifier : GMM,KNN,SVM, or RF. (str).
+        inCache : Keep the samples on disk, they are extracted again only if the image, the vector or
+            the field change, not used by a GMM learned from the statistics (bool).
+        inMaxSamples : Maximum number of pixels per class, drawn at random with inSeed (int).
+        inJobs : Number of threads reading the samples (int).
+        inLUT : Save the labels of the colours in the model (see get_lut), for images of at
+            most 3 bands of 8 bits, so the classification looks the pixels up (bool).
+
+    Without testing samples (inSplit of 1), a GMM is learned from the statistics of the samples,
+    accumulated block by block while they are read. Without inMaxSamples, the statistics of each
+    polygon are saved in the model, so updateModel can add new polygons to it later. The
+    regularization of a GMM learned on the samples is selected by cross validation, it is 0 when
+    learned from the statistics.
 
     Output :
         Model file.
@@ -157,102 +428,116 @@ class learnModel:
         outModel=None,
         outMatrix=None,
         inClassifier: str = "GMM",
+        inCache: bool = True,
+        inMaxSamples=None,
+        inJobs: int = 1,
+        inLUT: bool = False,
     ):
         learningProgress = progressBar("Learning model...", 6)
 
-        # Convert vector to raster
-        # try:
-        # try:
-        temp_folder = tempfile.mkdtemp()
-        filename = os.path.join(temp_folder, "temp.tif")
-
-        data = gdal.Open(inRaster, gdal.GA_ReadOnly)
-        shp = ogr.Open(inVector)
-
-        lyr = shp.GetLayer()
-        # except:
-        #     QgsMessageLog.logMessage(
-        #         "Problem with making tempfile or opening raster or vector"
-        #     )
-
-        # Create temporary data set
-        # try:
-        driver = gdal.GetDriverByName("GTiff")
-        dst_ds = driver.Create(
-            filename, data.RasterXSize, data.RasterYSize, 1, gdal.GDT_Byte
-        )
-        dst_ds.SetGeoTransform(data.GetGeoTransform())
-        dst_ds.SetProjection(data.GetProjection())
-        OPTIONS = f"ATTRIBUTE={inField}"
-        gdal.RasterizeLayer(dst_ds, [1], lyr, None, options=[OPTIONS])
-        data, dst_ds, shp, lyr = None, None, None, None
-        # except:
-        #     QgsMessageLog.logMessage("Cannot create temporary data set")
-
-        # Load Training set
-        # try:
-        X, Y = dataraster.get_samples_from_roi(inRaster, filename)
-        # except:
-        #     QgsMessageLog.logMessage(
-        #         f"Problem while getting samples from ROI with {inRaster}"
-        #     )
+        # Samples are cached, changing only the classifier or the split does not extract them again
+        X, Y = None, None
+        stats, features, fids = None, None, None
+        options = None
+        if inMaxSamples:
+            options = {"maxSamples": inMaxSamples, "seed": inSeed}
+        if inClassifier == "GMM" and inSplit >= 1:
+            # Only the statistics of the samples are needed, they are always computed from the
+            # image so the model does not depend on the cache
+            if not inMaxSamples:
+                # The statistics of each feature are kept in the model to update it
+                features = self.get_features(inVector, inField)
+                fids = [fid for fid, _ in features.values()]
+            stats = gmmr.GMMStats()
+            self.get_samples(
+                inRaster, inVector, inField, inMaxSamples, inSeed, inJobs, stats, fids
+            )
+            if not stats.ni.sum():
+                learningProgress.reset()
+                return
+        else:
+            if inCache:
+                X, Y = dataraster.load_samples_cache(
+                    inRaster, inVector, inField, options
+                )
+            if X is None:
+                X, Y = self.get_samples(
+                    inRaster, inVector, inField, inMaxSamples, inSeed, inJobs
+                )
+                if X is None:
+                    learningProgress.reset()
+                    return
+                if inCache:
+                    dataraster.save_samples_cache(
+                        X, Y, inRaster, inVector, inField, options
+                    )
 
-        [n, d] = X.shape
-        C = int(Y.max())
         SPLIT = inSplit
-        os.remove(filename)
-        os.rmdir(temp_folder)
 
-        # Scale the data
-        X, M, m = self.scale(X)
+        if stats is not None:
+            M, m = stats.M, stats.m
+        else:
+            # Samples are kept once, subsets are indices and are scaled when a classifier needs them
+            samples = dataraster.trainingSet(X, Y)
+            X, Y = None, None
+            M, m = samples.M, samples.m
 
         learningProgress.addStep()  # Add Step to ProgressBar
 
         # Learning process take split of groundthruth pixels for training and the remaining for testing
         # try:
         if SPLIT < 1:
-            # progressBar, set Max to C
-
             # Random selection of the sample
-            x = np.array([]).reshape(0, d)
-            y = np.array([]).reshape(0, 1)
-            xt = np.array([]).reshape(0, d)
-            yt = np.array([]).reshape(0, 1)
-
-            np.random.seed(inSeed)  # Set the random generator state
-            for i in range(C):
-                t = np.where((i + 1) == Y)[0]
-                nc = t.size
-                ns = int(nc * SPLIT)
-                rp = np.random.permutation(nc)
-                x = np.concatenate((X[t[rp[0:ns]], :], x))
-                xt = np.concatenate((X[t[rp[ns:]], :], xt))
-                y = np.concatenate((Y[t[rp[0:ns]]], y))
-                yt = np.concatenate((Y[t[rp[ns:]]], yt))
-                # Add Pb
+            train, test = samples.split(SPLIT, inSeed)
         # except:
         #     QgsMessageLog.logMessage("Problem while learning if SPLIT <1")
 
+        elif stats is None:
+            train, test = samples.get_index(), None
+
+        # Scanned maps have few colours, classifiers taking weights learn the distinct samples
+        if stats is not None:
+            x, y, fitParams = None, None, {}
+        elif inClassifier == "KNN":
+            x, y = samples.get(train)
+            fitParams = {}
         else:
-            x, y = X, Y
+            x, y, weight, _ = samples.get_unique(train)
+            fitParams = {"sample_weight": weight}
 
         learningProgress.addStep()  # Add Step to ProgressBar
         # Train Classifier
         # try:
         if inClassifier == "GMM":
-            # tau=10.0**sp.arange(-8,8,0.5)
             model = gmmr.GMMR()
-            model.learn(x, y)
-            # htau,err = model.cross_validation(x,y,tau)
-            # model.tau = htau
+            if features is not None:
+                # Statistics are labelled with the position of the features, from 1
+                model.stats = stats
+                model.features = {
+                    key: (k + 1, label)
+                    for k, (key, (_, label)) in enumerate(features.items())
+                }
+                stats = stats.relabel(dict(model.features.values()))
+            if stats is not None:
+                # The statistics are scaled like the samples
+                model.learn_stats(stats.affine(*dataraster.get_scaling(M, m)))
+            else:
+                model.learn(x, y, **fitParams)
+                # Regularization selected by cross validation on the pixels of the training
+                # samples, each fold keeps its distinct samples
+                tau = 10.0 ** np.arange(-8, 8, 0.5)
+                xf, yf, weight, fold = samples.get_unique_folds(5, train, inSeed)
+                htau, err = model.cross_validation(
+                    xf, yf, tau, sample_weight=weight, fold=fold
+                )
+                model.tau = htau
         # except:
         #     QgsMessageLog.logMessage("Cannot train with GMMM")
         else:
             # try:
             from sklearn import neighbors
-            from sklearn.model_selection import StratifiedKFold
             from sklearn.ensemble import RandomForestClassifier
-            from sklearn.model_selection import GridSearchCV
+            from sklearn.model_selection import GridSearchCV, PredefinedSplit
             from sklearn.svm import SVC
             # except:
             #     QgsMessageLog.logMessage(
@@ -270,37 +555,30 @@ class learnModel:
                     n_estimators=3 ** np.arange(1, 5),
                     max_features=np.arange(1, 4),
                 )
-                y.shape = (y.size,)
-                cv = StratifiedKFold(n_splits=3)
-                grid = GridSearchCV(
+                model = self.grid_search(
                     RandomForestClassifier(),
-                    param_grid=param_grid_rf,
-                    cv=cv.get_n_splits(y),
-                    n_jobs=n_jobs,
+                    param_grid_rf,
+                    samples.get_unique_folds(3, train, inSeed),
+                    n_jobs,
                 )
-                grid.fit(x, y)
-                model = grid.best_estimator_
-                model.fit(x, y)
+                model.fit(x, y, **fitParams)
             elif inClassifier == "SVM":
                 param_grid_svm = dict(
                     gamma=2.0 ** np.arange(-4, 4), C=10.0 ** np.arange(-2, 5)
                 )
-                y.shape = (y.size,)
-                cv = StratifiedKFold(n_splits=5)
-                grid = GridSearchCV(
-                    SVC(), param_grid=param_grid_svm, cv=cv.get_n_splits(y), n_jobs=n_jobs
+                model = self.grid_search(
+                    SVC(),
+                    param_grid_svm,
+                    samples.get_unique_folds(5, train, inSeed),
+                    n_jobs,
                 )
-                grid.fit(x, y)
-                model = grid.best_estimator_
-                model.fit(x, y)
+                model.fit(x, y, **fitParams)
             elif inClassifier == "KNN":
                 param_grid_knn = dict(n_neighbors=np.arange(1, 20, 4))
-                y.shape = (y.size,)
-                cv = StratifiedKFold(n_splits=3)
                 grid = GridSearchCV(
                     neighbors.KNeighborsClassifier(),
                     param_grid=param_grid_knn,
-                    cv=cv.get_n_splits(y),
+                    cv=PredefinedSplit(dataraster.get_folds(y, 3, inSeed)),
                     n_jobs=n_jobs,
                 )
                 grid.fit(x, y)
@@ -312,21 +590,31 @@ class learnModel:
             #         f"Cannot train with Classifier {inClassifier}"
             #     )
 
+        x, y = None, None
         learningProgress.prgBar.setValue(5)  # Add Step to ProgressBar
-        # Assess the quality of the model
+        # Assess the quality of the model, testing samples are scaled by chunks
         if SPLIT < 1:
             # if  inClassifier == 'GMM':
             #     yp = model.predict(xt)[0]
             # else:
-            yp = model.predict(xt)
+            # only the distinct testing samples are predicted
+            xt, _, _, inverse = samples.get_unique(test)
+            chunks = np.array_split(xt, max(1, xt.shape[0] // 100000))
+            yp = np.concatenate([model.predict(t) for t in chunks])[inverse]
+            yt = samples.Y[test]
             CONF = ai.CONFUSION_MATRIX()
             CONF.compute_confusion_matrix(yp, yt)
             np.savetxt(outMatrix, CONF.confusion_matrix, delimiter=",", fmt="%1.4d")
 
-        # Save Tree model
+        # Save Tree model, with the table of the colours
         if outModel is not None:
+            # The table is computed first, an error there keeps the previous model file
+            lut = self.get_lut(inRaster, model, M, m) if inLUT else None
             output = open(outModel, "wb")
-            pickle.dump([model, M, m], output)
+            if lut is None:
+                pickle.dump([model, M, m], output)
+            else:
+                pickle.dump([model, M, m, lut], output)
             output.close()
 
         learningProgress.addStep()  # Add Step to ProgressBar
@@ -337,35 +625,362 @@ class learnModel:
         # except:
         #     learningProgress.reset()
 
-    def scale(self, x, M=None, m=None):
-        """!@brief Function that standardize the data.
+    def grid_search(self, estimator, param_grid: dict, inFolds, inJobs: int = 1):
+        """!@brief Classifier with the parameters of the best cross validation accuracy.
 
-        Input:
-            x: the data
-            M: the Max vector
-            m: the Min vector
-        Output:
-            x: the standardize data
-            M: the Max vector
-            m: the Min vector
+        The folds are the distinct samples of each fold of pixels, with their number (see
+        trainingSet.get_unique_folds). They are learned and scored with these weights, so the
+        accuracy is the one of the pixels: GridSearchCV would score the distinct samples, a
+        colour seen once counting as much as a colour covering the map.
+
+        Input :
+            estimator : sklearn classifier taking a sample_weight.
+            param_grid : Values of each parameter (dict).
+            inFolds : (x, y, counts, fold) of trainingSet.get_unique_folds.
+            inJobs : Number of jobs, -1 for all the cores (int).
+
+        Output :
+            estimator : Copy of the estimator with the best parameters, not learned.
         """
-        [n, d] = x.shape
-        if not np.issubdtype(x.dtype, float):
-            x = x.astype("float")
+        from joblib import Parallel, delayed
+        from sklearn.base import clone
+        from sklearn.model_selection import ParameterGrid
+
+        x, y, weight, fold = inFolds
+        folds = np.unique(fold)
+
+        def score(params, k):
+            train, test = fold != k, fold == k
+            model = clone(estimator).set_params(**params)
+            model.fit(x[train], y[train], sample_weight=weight[train])
+            return np.dot(weight[test], model.predict(x[test]) == y[test])
+
+        grid = list(ParameterGrid(param_grid))
+        scores = Parallel(n_jobs=inJobs)(
+            delayed(score)(params, k) for params in grid for k in folds
+        )
+        scores = np.reshape(scores, (len(grid), folds.size)).sum(axis=1)
+        best = grid[int(scores.argmax())]
+        QgsMessageLog.logMessage(
+            f"Parameters {best}, cross validation accuracy "
+            f"{100.0 * scores.max() / weight.sum():.2f}%"
+        )
+        return clone(estimator).set_params(**best)
 
-        # Initialization of the output
-        xs = np.empty_like(x)
+    def get_samples(
+        self,
+        inRaster: str,
+        inVector: str,
+        inField: str,
+        inMaxSamples=None,
+        inSeed: int = 0,
+        inJobs: int = 1,
+        inStats=None,
+        inFeatures=None,
+    ):
+        """!@brief Rasterize the training features and get the pixels under them.
 
-        # get the parameters of the scaling
-        M, m = np.amax(x, axis=0), np.amin(x, axis=0)
-        den = M - m
-        for i in range(d):
-            if den[i] != 0:
-                xs[:, i] = 2 * (x[:, i] - m[i]) / den[i] - 1
+        Input :
+            inRaster : Filtered image name ('sample_filtered.tif',str).
+            inVector : Name of the training shpfile ('training.shp',str).
+            inField : Column name where are stored class number (str).
+            inMaxSamples : Maximum number of pixels per class, None to keep them all (int).
+            inSeed : Seed of the random selection of the pixels (int).
+            inJobs : Number of threads reading the samples (int).
+            inStats : Statistics updated with the samples instead of returning them
+                (gmm_ridge.GMMStats).
+            inFeatures : FIDs of the features to rasterize, each one is labelled with its position
+                in the list, from 1, instead of its class. None for all the features by class (list).
+
+        Output :
+            X : Samples, one line per pixel, with the data type of the image (None if no feature
+                is on the image or with inStats).
+            Y : Labels of the samples.
+        """
+        # Convert vector to raster
+        # try:
+        # try:
+        filename = f"/vsimem/historical_map_roi_{id(self)}.tif"
+
+        data = gdal.Open(inRaster, gdal.GA_ReadOnly)
+        shp = ogr.Open(inVector)
+
+        lyr = shp.GetLayer()
+        # except:
+        #     QgsMessageLog.logMessage(
+        #         "Problem with making tempfile or opening raster or vector"
+        #     )
+
+        # The selected features are copied in memory with their position as label
+        mem, dataType = None, gdal.GDT_Byte
+        if inFeatures is not None:
+            mem = ogr.GetDriverByName("Memory").CreateDataSource("")
+            memLyr = mem.CreateLayer("features", lyr.GetSpatialRef(), lyr.GetGeomType())
+            memLyr.CreateField(ogr.FieldDefn("feature", ogr.OFTInteger))
+            for k, fid in enumerate(inFeatures):
+                feat = ogr.Feature(memLyr.GetLayerDefn())
+                feat.SetGeometry(lyr.GetFeature(fid).GetGeometryRef())
+                feat.SetField("feature", k + 1)
+                memLyr.CreateFeature(feat)
+            lyr, inField = memLyr, "feature"
+            if len(inFeatures) < 65536:
+                dataType = gdal.GDT_UInt16
             else:
-                xs[:, i] = x[:, i]
+                dataType = gdal.GDT_UInt32
+
+        # Envelopes of the features in the projection of the raster
+        geo = data.GetGeoTransform()
+        nc, nl = data.RasterXSize, data.RasterYSize
+        srs = osr.SpatialReference(wkt=data.GetProjection())
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        lyrSrs = lyr.GetSpatialRef()
+        transform = None
+        if lyrSrs is None or not data.GetProjection() or srs.IsSame(lyrSrs):
+            # Features outside the raster are not read
+            xs = [geo[0] + c * geo[1] + l * geo[2] for c in (0, nc) for l in (0, nl)]
+            ys = [geo[3] + c * geo[4] + l * geo[5] for c in (0, nc) for l in (0, nl)]
+            lyr.SetSpatialFilterRect(min(xs), min(ys), max(xs), max(ys))
+        else:
+            transform = osr.CoordinateTransformation(lyrSrs, srs)
+        envelopes = []
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            if geom is None:
+                continue
+            if transform is not None:
+                geom = geom.Clone()
+                geom.Transform(transform)
+            envelopes.append(geom.GetEnvelope())
+        windows = [
+            dataraster.get_envelope_window(geo, envelope, nl, nc)
+            for envelope in envelopes
+        ]
+        windows = [window for window in windows if window is not None]
+        if not windows:
+            QgsMessageLog.logMessage(f"No feature of {inVector} is on {inRaster}")
+            return None, None
+
+        # The features are rasterized in memory, on the window of the raster they cover
+        xoff = min(window[0] for window in windows)
+        yoff = min(window[1] for window in windows)
+        xsize = max(window[0] + window[2] for window in windows) - xoff
+        ysize = max(window[1] + window[3] for window in windows) - yoff
+        # try:
+        driver = gdal.GetDriverByName("GTiff")
+        # Tiled and sparse, the empty blocks of the window take no memory
+        dst_ds = driver.Create(
+            filename,
+            xsize,
+            ysize,
+            1,
+            dataType,
+            options=["TILED=YES", "COMPRESS=DEFLATE", "SPARSE_OK=TRUE"],
+        )
+        dst_ds.SetGeoTransform(
+            (
+                geo[0] + xoff * geo[1] + yoff * geo[2],
+                geo[1],
+                geo[2],
+                geo[3] + xoff * geo[4] + yoff * geo[5],
+                geo[4],
+                geo[5],
+            )
+        )
+        dst_ds.SetProjection(data.GetProjection())
+        OPTIONS = f"ATTRIBUTE={inField}"
+        lyr.ResetReading()
+        gdal.RasterizeLayer(dst_ds, [1], lyr, None, options=[OPTIONS])
+        data, dst_ds, shp, lyr, mem = None, None, None, None, None
+        # except:
+        #     QgsMessageLog.logMessage("Cannot create temporary data set")
+
+        # Load Training set, only the blocks under the features are read
+        # try:
+        X, Y = dataraster.get_samples_from_roi(
+            inRaster,
+            filename,
+            envelopes,
+            (xoff, yoff, xsize, ysize),
+            inMaxSamples,
+            inSeed,
+            inJobs,
+            inStats,
+        )
+        # except:
+        #     QgsMessageLog.logMessage(
+        #         f"Problem while getting samples from ROI with {inRaster}"
+        #     )
+
+        gdal.Unlink(filename)
+        return X, Y
+
+    def get_lut(self, inRaster: str, model, M, m):
+        """!@brief Label of the colours of the image (see dataraster.get_colour_table).
+
+        A GMM predicts all the colours. Other classifiers are slower, they only predict the
+        colours used by the image, the other ones are predicted during the classification. The
+        pixels are scaled as in classifyImage.predict_image.
+
+        Input :
+            inRaster : Filtered image name ('sample_filtered.tif',str).
+            model : Learned classifier.
+            M, m : Maximum and minimum of each band for the scaling.
+
+        Output :
+            lut : Label of each colour (uint8 array), None if the image does not have at most 3
+                bands of 8 bits.
+        """
+        data = gdal.Open(inRaster, gdal.GA_ReadOnly)
+        d = data.RasterCount
+        if d > 3 or data.GetRasterBand(1).DataType != gdal.GDT_Byte:
+            QgsMessageLog.logMessage(
+                f"No colour table for {inRaster}, it needs at most 3 bands of 8 bits"
+            )
+            return None
+        data = None
 
-        return xs, M, m
+        if isinstance(model, gmmr.GMMR):
+            return dataraster.get_colour_table(
+                model.with_scaling(*dataraster.get_scaling(M, m)).predict, d
+            )
+
+        den = M - m
+        ok = den != 0
+
+        def predict(x):
+            x[:, ok] = 2 * (x[:, ok] - m[ok]) / den[ok] - 1
+            return model.predict(x)
+
+        colours = dataraster.get_image_colours(inRaster)
+        QgsMessageLog.logMessage(
+            f"Colour table of the {colours.size} colours of {inRaster}"
+        )
+        return dataraster.get_colour_table(predict, d, colours)
+
+    def get_features(self, inVector: str, inField: str):
+        """!@brief Identify the training features by their geometry and class.
+
+        Input :
+            inVector : Name of the training shpfile ('training.shp',str).
+            inField : Column name where are stored class number (str).
+
+        Output :
+            features : (FID, class) of each feature with a class, by SHA-1 of its geometry and
+                class (dict).
+        """
+        shp = ogr.Open(inVector)
+        lyr = shp.GetLayer()
+        features = {}
+        for feat in lyr:
+            geom = feat.GetGeometryRef()
+            label = feat.GetFieldAsInteger(inField)
+            if geom is None or label <= 0:
+                continue
+            key = hashlib.sha1(geom.ExportToWkb() + str(label).encode()).hexdigest()
+            features[key] = (feat.GetFID(), label)
+        shp, lyr = None, None
+        return features
+
+
+class updateModel(learnModel):
+    """!@brief Update a GMM model with the training features added, changed or removed since it
+    was learned.
+
+    The model keeps the statistics of each feature (see learnModel), so only the new or changed
+    features are rasterized and read, and the GMM is computed again from the statistics, without
+    the samples of the other features.
+
+    Input :
+        inRaster : Filtered image name ('sample_filtered.tif',str).
+        inVector : Name of the training shpfile ('training.shp',str).
+        inField : Column name where are stored class number (str).
+        inModel : Model to update, learned with a GMM without testing samples nor maximum number
+            of samples (str).
+        inJobs : Number of threads reading the samples (int).
+
+    Output :
+        Model file.
+        self.message : Why the model was not updated, None if it was (str).
+    """
+
+    def __init__(
+        self,
+        inRaster: str,
+        inVector: str,
+        inField: str = "Class",
+        inModel=None,
+        inJobs: int = 1,
+    ):
+        self.message = None
+        if not inModel or not os.path.isfile(inModel):
+            self.message = f"There is no model {inModel} to update"
+            QgsMessageLog.logMessage(self.message)
+            return
+
+        updateProgress = progressBar("Updating model...", 3)
+
+        model = open(inModel, "rb")
+        data = pickle.load(model)
+        model.close()
+        tree, M, m = data[:3]
+        if getattr(tree, "features", None) is None:
+            self.message = f"{inModel} does not keep the statistics of its training features, it can not be updated"
+            QgsMessageLog.logMessage(self.message)
+            updateProgress.reset()
+            return
+
+        # Features whose geometry or class changed are removed and added again
+        features = self.get_features(inVector, inField)
+        removed = [key for key in tree.features if key not in features]
+        added = [key for key in features if key not in tree.features]
+        if not removed and not added:
+            self.message = f"{inModel} is up to date with {inVector}"
+            QgsMessageLog.logMessage(self.message)
+            updateProgress.reset()
+            return
+        updateProgress.addStep()
+
+        stats = gmmr.GMMStats()
+        if added:
+            self.get_samples(
+                inRaster,
+                inVector,
+                inField,
+                inJobs=inJobs,
+                inStats=stats,
+                inFeatures=[features[key][0] for key in added],
+            )
+        updateProgress.addStep()
+
+        # New features get labels after the ones of the model
+        first = max([label for label, _ in tree.features.values()] + [0])
+        tree.stats.remove([tree.features.pop(key)[0] for key in removed])
+        tree.stats.merge(
+            stats.relabel({k + 1: first + k + 1 for k in range(len(added))})
+        )
+        for k, key in enumerate(added):
+            tree.features[key] = (first + k + 1, features[key][1])
+        stats = tree.stats.relabel(dict(tree.features.values()))
+        if not stats.ni.sum():
+            self.message = f"No training sample left in {inModel}"
+            QgsMessageLog.logMessage(self.message)
+            updateProgress.reset()
+            return
+
+        # The scaling is the one of all the samples
+        M, m = stats.M, stats.m
+        tree.learn_stats(stats.affine(*dataraster.get_scaling(M, m)))
+        # The table of the colours is computed again, before the model file is opened
+        lut = self.get_lut(inRaster, tree, M, m) if len(data) > 3 else None
+        output = open(inModel, "wb")
+        if lut is None:
+            pickle.dump([tree, M, m], output)
+        else:
+            pickle.dump([tree, M, m, lut], output)
+        output.close()
+
+        updateProgress.reset()
+        updateProgress = None
 
 
 class classifyImage:
@@ -379,16 +994,46 @@ class classifyImage:
             inModel : Output name of the filtered file ('training.shp',str)
             outShpFile : Output name of vector files ('sample.shp',str)
             inMinSize : min size in acre for the forest, ex 6 means all polygons below 6000 m2 (int)
-            TODO inMask : Mask size where no classification is done                                     |||| NOT YET IMPLEMENTED
             inField : Column name where are stored class number (str)
             inNODATA : if NODATA (int)
             inClassForest : Classification number of the forest class (int)
+            inMask : Mask of the map (see dataraster.get_map_mask), nothing is classified
+                outside it (str)
+            inResolution : Ground resolution of the classification, None to keep the image one
+                (float). The image is averaged before prediction and the classification takes
+                the most frequent label before the sieve. inMinSize is an area so it does not
+                depend on it.
 
         Output :
             SHP file with deleted polygon below inMinSize
     """
 
-    def initPredict(self, inRaster: str, inModel: str):
+    def __init__(self, inResolution=None):
+        self.inResolution = inResolution
+
+    def resample(self, inRaster: str, inLabels=False):
+        """!@brief Resample a raster at self.inResolution in a temp file, if needed.
+
+        The temp file is deleted with removeResampled.
+        """
+        if not self.inResolution:
+            return inRaster
+        temp_folder = tempfile.mkdtemp()
+        rasterTemp = os.path.join(temp_folder, "resampled.tif")
+        inRaster, factor = dataraster.resample_image(
+            inRaster, rasterTemp, self.inResolution, inLabels
+        )
+        if inRaster != rasterTemp:
+            os.rmdir(temp_folder)
+        return inRaster
+
+    def removeResampled(self, inRaster: str, resampled: str):
+        """!@brief Delete the raster made by resample from inRaster, and its temp folder"""
+        if resampled != inRaster:
+            os.remove(resampled)
+            os.rmdir(os.path.dirname(resampled))
+
+    def initPredict(self, inRaster: str, inModel: str, inMask=None):
         # Load model
         self.Progress = progressBar(" Classification ", 3)
         # try:
@@ -397,8 +1042,11 @@ class classifyImage:
             print("Model not load")
             QgsMessageLog.logMessage(f"Model : {inModel} is none")
         else:
-            tree, M, m = pickle.load(model)
+            data = pickle.load(model)
             model.close()
+            # The table of the colours is optional
+            tree, M, m = data[:3]
+            lut = data[3] if len(data) > 3 else None
         # except:
         #     QgsMessageLog.logMessage(f"Error while loading the model : {inModel}")
 
@@ -410,13 +1058,21 @@ class classifyImage:
         #     QgsMessageLog.logMessage(f"Cannot create temp file {rasterTemp}")
         #     # Process the data
         # try:
+        resampled = self.resample(inRaster)
         predictedImage = self.predict_image(
-            inRaster, rasterTemp, tree, None, -10000, SCALE=[M, m]
+            resampled,
+            rasterTemp,
+            tree,
+            inMask,
+            -10000,
+            SCALE=[M, m],
+            inLUT=lut,
         )
         # except:
         #     QgsMessageLog.logMessage(
         #         f"Problem while predicting {inRaster} in temp {rasterTemp}"
         #     )
+        self.removeResampled(inRaster, resampled)
         self.Progress.addStep()
 
         return predictedImage
@@ -460,7 +1116,7 @@ class classifyImage:
         ioShpFile.Destroy()
         return outShp
 
-    def reclassAndFillHole(self, rasterTemp, inClassNumber):
+    def reclassAndFillHole(self, rasterTemp, inClassNumber, inMask=None):
         """!@brief Reclass and file hole (with ndimage morphology binary fill hole) for last treatment (need raster and class number)"""
         dst_ds = gdal.Open(rasterTemp, gdal.GA_Update)
         srcband = dst_ds.GetRasterBand(1).ReadAsArray()
@@ -471,20 +1127,34 @@ class classifyImage:
 
         srcband = ndimage.morphology.binary_fill_holes(srcband)
 
+        # Nothing is kept outside the map
+        if inMask is not None:
+            mask = gdal.Open(inMask, gdal.GA_ReadOnly)
+            srcband[
+                ~dataraster.read_mask(
+                    mask.GetRasterBand(1),
+                    (0, 0, dst_ds.RasterXSize, dst_ds.RasterYSize),
+                    dst_ds.RasterYSize,
+                    dst_ds.RasterXSize,
+                )
+            ] = 0
+            mask = None
+
         dst_ds.GetRasterBand(1).WriteArray(srcband)
         dst_ds.FlushCache()
         return rasterTemp
 
-    def postClassVector(self, inRaster, sieveSize, inClassNumber, outShp):
+    def postClassVector(self, inRaster, sieveSize, inClassNumber, outShp, inMask=None):
         """!@brief Sieve size with vector areas method, them reclass to delete unwanted labels"""
 
         # reclass and fill hole
-        inRaster = self.reclassAndFillHole(inRaster, inClassNumber)
+        resampled = self.resample(inRaster, True)
+        rasterTemp = self.reclassAndFillHole(resampled, inClassNumber, inMask)
         self.Progress.addStep()
 
         # Vectorizing with gdal.Polygonize
         # try:
-        sourceRaster = gdal.Open(inRaster)
+        sourceRaster = gdal.Open(rasterTemp)
         band = sourceRaster.GetRasterBand(1)
         driver = ogr.GetDriverByName("ESRI Shapefile")
         # If shapefile already exist, delete it
@@ -504,8 +1174,9 @@ class classifyImage:
         gdal.Polygonize(band, None, outLayer, 0, [], callback=None)
         outDatasource.Destroy()
         sourceRaster = None
+        self.removeResampled(inRaster, resampled)
         # except:
-        #     QgsMessageLog.logMessage(f"Cannot vectorize {inRaster}")
+        #     QgsMessageLog.logMessage(f"Cannot vectorize {rasterTemp}")
         #     self.Progress.reset()
 
         # try:
@@ -537,17 +1208,18 @@ class classifyImage:
         self.Progress.reset()
         return outShp
 
-    def postClassRaster(self, inRaster, sieveSize, inClassNumber, outShp):
+    def postClassRaster(self, inRaster, sieveSize, inClassNumber, outShp, inMask=None):
         """!@brief Sieve size with gdal.Sieve() fiunction, them reclass to delete unwanted labels"""
         # try:
         rasterTemp = tempfile.mktemp(".tif")
-        datasrc = gdal.Open(inRaster)
+        resampled = self.resample(inRaster, True)
+        datasrc = gdal.Open(resampled)
         srcband = datasrc.GetRasterBand(1)
-        data, im = dataraster.open_data_band(inRaster)
+        data, im = dataraster.open_data_band(resampled)
 
         drv = gdal.GetDriverByName("GTiff")
         dst_ds = drv.Create(
-            rasterTemp, datasrc.RasterXSize, datasrc.RasterXSize, 1, gdal.GDT_Byte
+            rasterTemp, datasrc.RasterXSize, datasrc.RasterYSize, 1, gdal.GDT_Byte
         )
 
         dst_ds.SetGeoTransform(datasrc.GetGeoTransform())
@@ -558,7 +1230,7 @@ class classifyImage:
         def sieve(srcband, dstband, sieveSize):
             gdal.SieveFilter(srcband, None, dstband, sieveSize, 8)
 
-        pixelSize = datasrc.GetGeoTransform()[1]  # get pixel size
+        pixelSize = abs(datasrc.GetGeoTransform()[1])  # get pixel size
         pixelSieve = int(
             sieveSize / (pixelSize * pixelSize)
         )  # get number of pixel to sieve
@@ -566,10 +1238,12 @@ class classifyImage:
         sieve(srcband, dstband, pixelSieve)
 
         dst_ds = None  # close destination band
+        datasrc, srcband, data, im = None, None, None, None
+        self.removeResampled(inRaster, resampled)
 
         self.Progress.addStep()
 
-        rasterTemp = self.reclassAndFillHole(rasterTemp, inClassNumber)
+        rasterTemp = self.reclassAndFillHole(rasterTemp, inClassNumber, inMask)
 
         self.Progress.addStep()
         # except:
@@ -584,9 +1258,11 @@ class classifyImage:
         self.Progress.reset()
         return outShp
 
-    def scale(self, x, M=None, m=None):  # TODO:  DO IN PLACE SCALING
+    def scale(self, x, M=None, m=None):
         """!@brief Function that standardize the data
 
+        A float array is scaled in place, with the operations of 2 * (x - m) / (M - m) - 1 on
+        all the columns at once.
         Input:
             x: the data
             M: the Max vector
@@ -596,28 +1272,36 @@ class classifyImage:
             M: the Max vector
             m: the Min vector
         """
-        [n, d] = x.shape
         if not np.issubdtype(x.dtype, float):
             x = x.astype("float")
 
-        # Initialization of the output
-        xs = np.empty_like(x)
-
         # get the parameters of the scaling
         if M is None:
             M, m = np.amax(x, axis=0), np.amin(x, axis=0)
 
+        # Constant columns are not scaled
         den = M - m
-        for i in range(d):
-            if den[i] != 0:
-                xs[:, i] = 2 * (x[:, i] - m[i]) / den[i] - 1
-            else:
-                xs[:, i] = x[:, i]
+        ok = den != 0
+        if ok.all():
+            x -= m
+            x *= 2
+            x /= den
+            x -= 1
+        else:
+            x[:, ok] = 2 * (x[:, ok] - m[ok]) / den[ok] - 1
 
-        return xs
+        return x
 
     def predict_image(
-        self, inRaster, outRaster, model, inMask=None, NODATA=-10000, SCALE=None
+        self,
+        inRaster,
+        outRaster,
+        model,
+        inMask=None,
+        NODATA=-10000,
+        SCALE=None,
+        inLUT=None,
+        inUnique: bool = True,
     ):
         """!@brief The function classify the whole raster image, using per block image analysis.
 
@@ -627,9 +1311,14 @@ class classifyImage:
                 inRaster : Filtered image name ('sample_filtered.tif',str)
                 outRaster :Raster image name ('outputraster.tif',str)
                 model : model file got from precedent step ('model', str)
-                inMask : mask to
+                inMask : mask of the pixels to classify, can be smaller than the image (str)
                 NODATA : Default set to -10000 (int)
-                SCALE : Default set to None
+                SCALE : [M, m] scaling of the model, None if it takes the pixels. A GMM does the
+                    scaling with its whitening matrices, other classifiers get scaled pixels.
+                inLUT : label of each colour (see learnModel.get_lut), the model only predicts
+                    the colours whose label is 0 in it
+                inUnique : predict each colour of a block once, the colours of integer images are
+                    also kept in a cache for the next blocks (bool)
 
             Output :
                 nothing but save a raster image
@@ -648,20 +1337,38 @@ class classifyImage:
             if mask is None:
                 print("Impossible to open {inMask}")
                 exit()
-            # Check size
-            if (raster.RasterXSize != mask.RasterXSize) or (
-                raster.RasterYSize != mask.RasterYSize
-            ):
-                print("Image and mask should be of the same size")
-                exit()
         if SCALE is not None:
             M, m = np.asarray(SCALE[0]), np.asarray(SCALE[1])
+            if isinstance(model, gmmr.GMMR):
+                model = model.with_scaling(*dataraster.get_scaling(M, m))
+                SCALE = None
 
         # Get the size of the image
         d = raster.RasterCount
         nc = raster.RasterXSize
         nl = raster.RasterYSize
 
+        # Index of the colour of a pixel in the table
+        if inLUT is not None and (
+            inLUT.size != 256 ** d or raster.GetRasterBand(1).DataType != gdal.GDT_Byte
+        ):
+            QgsMessageLog.logMessage(f"The colour table does not fit {inRaster}")
+            inLUT = None
+        colour = 256.0 ** np.arange(d)
+
+        # Colours of integer images are packed in one key, the labels of the last ones are kept
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+            raster.GetRasterBand(1).DataType
+        )
+        cache = None
+        if inUnique and np.issubdtype(dtype, np.integer):
+            cache = dataraster.colourCache()
+
+        def predict(x):
+            if SCALE is None:
+                return model.predict(x).astype("uint8")
+            return model.predict(self.scale(x, M=M, m=m)).astype("uint8")
+
         # Get the geoinformation
         GeoTransform = raster.GetGeoTransform()
         Projection = raster.GetProjection()
@@ -692,6 +1399,15 @@ class classifyImage:
                 else:
                     cols = nc - j
 
+                # Blocks outside the mask are not read
+                if mask is not None:
+                    mask_temp = dataraster.read_mask(
+                        mask.GetRasterBand(1), (j, i, cols, lines), nl, nc
+                    ).reshape(cols * lines)
+                    if not mask_temp.any():
+                        out.WriteArray(np.zeros((lines, cols), dtype=np.uint8), j, i)
+                        continue
+
                 # Load the data and Do the prediction
                 X = np.empty((cols * lines, d))
                 for ind in range(d):
@@ -711,17 +1427,34 @@ class classifyImage:
                     t = np.where((mask_temp != 0) & (X[:, 0] != NODATA))[0]
                     yp = np.zeros((cols * lines,))
                 else:
-                    mask_temp = (
-                        mask.GetRasterBand(1)
-                        .ReadAsArray(j, i, cols, lines)
-                        .reshape(cols * lines)
-                    )
-                    t = np.where((mask_temp != 0) & (X[:, 0] != NODATA))[0]
+                    t = np.where(mask_temp & (X[:, 0] != NODATA))[0]
                     yp = np.zeros((cols * lines,))
 
-                # TODO: Change this part accorindgly ...
-                if t.size > 0:
-                    yp[t] = model.predict(self.scale(X[t, :], M=M, m=m)).astype("uint8")
+                # Colours missing in the table are predicted by the model
+                if t.size > 0 and inLUT is not None:
+                    yp[t] = inLUT[np.dot(X[t, :], colour).astype(np.int64)]
+                    t = t[yp[t] == 0]
+
+                keys = None
+                if t.size > 0 and cache is not None:
+                    keys = dataraster.get_colour_keys(X[t, :], dtype)
+
+                if t.size > 0 and keys is not None:
+                    # Only the colours missing in the cache are predicted
+                    keys, first, inverse = np.unique(
+                        keys, return_index=True, return_inverse=True
+                    )
+                    labels, found = cache.get(keys)
+                    new = np.where(~found)[0]
+                    if new.size > 0:
+                        labels[new] = predict(X[t[first[new]], :])
+                        cache.add(keys[new], labels[new])
+                    yp[t] = labels[inverse.ravel()]
+                elif t.size > 0 and inUnique:
+                    x, inverse = np.unique(X[t, :], axis=0, return_inverse=True)
+                    yp[t] = predict(x)[inverse.ravel()]
+                elif t.size > 0:
+                    yp[t] = predict(X[t, :])
 
                 # Write the data
                 out.WriteArray(yp.reshape(lines, cols), j, i)
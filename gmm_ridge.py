@@ -4,22 +4,12 @@
 """
 from __future__ import annotations
 
-import multiprocessing as mp
+import copy
 
 import numpy as np
 from numpy import linalg
 
 
-## Temporary predict function
-def predict(tau, model, xT, yT):
-    err = np.zeros(tau.size)
-    for j, t in enumerate(tau):
-        yp = model.predict(xT, tau=t)[0]
-        eq = np.where(yp.ravel() == yT.ravel())[0]
-        err[j] = eq.size * 100.0 / yT.size
-    return err
-
-
 class CV:
     """
     This class implements the generation of several folds to be used in the cross validation
@@ -37,68 +27,214 @@ class CV:
         Output: None
         """
         step = n // v  # Compute the number of samples in each fold
-        np.random.seed(1)  # Set the random generator to the same initial state
-        t = np.random.permutation(n)  # Generate random sampling of the indices
-
-        indices = []
-        for i in range(v - 1):  # group in v fold
-            indices.append(t[i * step : (i + 1) * step])
-        indices.append(t[(v - 1) * step : n])
+        # Set the random generator to the same initial state
+        rs = np.random.RandomState(1)
+        t = rs.permutation(n)  # Generate random sampling of the indices
 
+        # Fold of each sample, the last one gets the remaining samples
+        fold = np.empty(n, dtype=np.int64)
+        fold[t] = np.minimum(np.arange(n) // max(step, 1), v - 1)
         for i in range(v):
-            self.iT.append(np.asarray(indices[i]))
-            l = range(v)
-            l.remove(i)
-            temp = np.empty(0, dtype=np.int64)
-            for j in l:
-                temp = np.concatenate((temp, np.asarray(indices[j])))
-            self.it.append(temp)
+            self.iT.append(np.where(fold == i)[0])
+            self.it.append(np.where(fold != i)[0])
 
     def split_data_class(self, y, v=5):
         """The function split the data into v folds. The samples of each class are split approximatly in v folds
         Input:
-            n : the number of samples
+            y : the labels of the samples
             v : the number of folds
         Output: None
         """
         # Get parameters
+        y = np.asarray(y).ravel()
         n = y.size
         C = y.max().astype("int")
 
-        # Get the step for each class
-        tc = []
+        # Fold of each sample, -1 for the samples out of the classes
+        fold = np.full(n, -1, dtype=np.int64)
+        for i in range(C):
+            # Get all samples for each class
+            t = np.where(y == (i + 1))[0]
+            nc = t.size
+            if nc == 0:
+                continue
+            stepc = nc // v  # Step size for each class
+            if stepc == 0:
+                print(f"Not enough sample to build {v} folds in class {i}")
+            # Random sampling of indices of samples for class i, always the same one
+            rs = np.random.RandomState(i)
+            tc = t[rs.permutation(nc)]
+
+            # The last fold gets the remaining samples
+            fold[tc] = np.minimum(np.arange(nc) // max(stepc, 1), v - 1)
+            if stepc == 0:
+                fold[tc] = v - 1
+
         for j in range(v):
-            tempit = []
-            tempiT = []
-            for i in range(C):
-                # Get all samples for each class
-                t = np.where(y == (i + 1))[0]
-                nc = t.size
-                stepc = nc // v  # Step size for each class
-                if stepc == 0:
-                    print(f"Not enough sample to build {v} folds in class {i}")
-                np.random.seed(i)  # Set the random generator to the same initial state
-                tc = t[
-                    np.random.permutation(nc)
-                ]  # Random sampling of indices of samples for class i
-
-                # Set testing and training samples
-                if j < (v - 1):
-                    start, end = j * stepc, (j + 1) * stepc
-                else:
-                    start, end = j * stepc, nc
-                tempiT.extend(np.asarray(tc[start:end]))  # Testing
-                k = range(v)
-                k.remove(j)
-                for l in k:
-                    if l < (v - 1):
-                        start, end = l * stepc, (l + 1) * stepc
-                    else:
-                        start, end = l * stepc, nc
-                    tempit.extend(np.asarray(tc[start:end]))  # Training
+            self.it.append(np.where((fold != j) & (fold >= 0))[0])  # Training
+            self.iT.append(np.where(fold == j)[0])  # Testing
+
+    def split_data_fold(self, fold, v=5):
+        """The function uses folds given for each sample
+        Input:
+            fold : the fold of each sample, from 0 to v-1 (-1 for samples out of the folds)
+            v : the number of folds
+        Output: None
+        """
+        fold = np.asarray(fold).ravel()
+        for j in range(v):
+            self.it.append(np.where((fold != j) & (fold >= 0))[0])  # Training
+            self.iT.append(np.where(fold == j)[0])  # Testing
 
-            self.it.append(tempit)
-            self.iT.append(tempiT)
+
+class GMMStats:
+    """
+    This class accumulates the sufficient statistics of the GMM: for each class, the number of
+    samples, their sum and the sum of their outer products. Samples are added block by block, the
+    statistics of several workers are merged, and GMMR.learn_stats computes the model from them, so
+    the samples never need to be in memory together.
+    The labels can be other groups than the classes, e.g. the training polygons, and relabel gives
+    the statistics of the classes.
+    """
+
+    def __init__(self):
+        self.classnum = np.empty(0, dtype=np.int64)
+        self.ni = np.empty(0)  # Number of samples of each class
+        self.sum = None  # Sum of the samples of each class
+        self.outer = None  # Sum of the outer products of the samples of each class
+        self.M = None  # Maximum of each variable
+        self.m = None  # Minimum of each variable
+
+    def get_class(self, cR):
+        """Index of the label cR in the statistics, a new class is added if needed"""
+        k = np.where(self.classnum == cR)[0]
+        if k.size:
+            return k[0]
+        d = self.sum.shape[1]
+        self.classnum = np.append(self.classnum, cR)
+        self.ni = np.append(self.ni, 0.0)
+        self.sum = np.concatenate((self.sum, np.zeros((1, d))))
+        self.outer = np.concatenate((self.outer, np.zeros((1, d, d))))
+        return self.ni.size - 1
+
+    def init(self, d):
+        """Set the number of variables before the first samples"""
+        if self.sum is None:
+            self.sum = np.empty((0, d))
+            self.outer = np.empty((0, d, d))
+            self.M = np.full(d, -np.inf)
+            self.m = np.full(d, np.inf)
+
+    def update(self, x, y, sample_weight=None):
+        """
+        Function that adds a block of samples to the statistics
+        Input:
+            x : the samples, of any numeric type
+            y : the labels
+            sample_weight : number of times each sample is counted (optional)
+        Output: None
+        """
+        y = np.asarray(y).ravel()
+        self.init(x.shape[1])
+        if y.size == 0:
+            return
+        self.M = np.maximum(self.M, np.amax(x, axis=0))
+        self.m = np.minimum(self.m, np.amin(x, axis=0))
+
+        for cR in np.unique(y):
+            j = np.where(y == cR)[0]
+            xc = x[j, :].astype(np.float64)
+            k = self.get_class(cR)
+            if sample_weight is None:
+                self.ni[k] += j.size
+                self.sum[k, :] += np.sum(xc, axis=0)
+                self.outer[k, :, :] += np.dot(xc.T, xc)
+            else:
+                w = np.asarray(sample_weight, dtype=np.float64).ravel()[j]
+                self.ni[k] += w.sum()
+                self.sum[k, :] += np.dot(w, xc)
+                self.outer[k, :, :] += np.dot(xc.T * w, xc)
+
+    def merge(self, stats):
+        """
+        Function that adds the statistics of other samples, e.g. computed by another worker
+        Input:
+            stats : a GMMStats
+        Output:
+            self
+        """
+        if stats.sum is None:
+            return self
+        self.init(stats.sum.shape[1])
+        self.M = np.maximum(self.M, stats.M)
+        self.m = np.minimum(self.m, stats.m)
+        for c, cR in enumerate(stats.classnum):
+            k = self.get_class(cR)
+            self.ni[k] += stats.ni[c]
+            self.sum[k, :] += stats.sum[c, :]
+            self.outer[k, :, :] += stats.outer[c, :, :]
+        return self
+
+    def remove(self, classnum):
+        """
+        Function that removes the statistics of some labels
+        Input:
+            classnum : the labels to remove, missing ones are ignored
+        Output:
+            self
+        """
+        if self.sum is not None:
+            k = np.where(~np.isin(self.classnum, classnum))[0]
+            self.classnum = self.classnum[k]
+            self.ni = self.ni[k]
+            self.sum = self.sum[k, :]
+            self.outer = self.outer[k, :, :]
+        return self
+
+    def relabel(self, labels):
+        """
+        Function that computes the statistics of new labels, groups sharing a label are merged
+        Input:
+            labels : the new label of each label (dict)
+        Output:
+            stats : a new GMMStats
+        """
+        stats = GMMStats()
+        if self.sum is None:
+            return stats
+        stats.init(self.sum.shape[1])
+        stats.M, stats.m = self.M.copy(), self.m.copy()
+        for c, cR in enumerate(self.classnum):
+            k = stats.get_class(labels[cR])
+            stats.ni[k] += self.ni[c]
+            stats.sum[k, :] += self.sum[c, :]
+            stats.outer[k, :, :] += self.outer[c, :, :]
+        return stats
+
+    def affine(self, a, b):
+        """
+        Function that computes the statistics of the samples transformed by x*a + b, e.g. scaled
+        once the minimum and maximum of the whole set are known
+        Input:
+            a : the factor of each variable
+            b : the offset of each variable
+        Output:
+            stats : a new GMMStats
+        """
+        stats = GMMStats()
+        stats.classnum = self.classnum.copy()
+        stats.ni = self.ni.copy()
+        stats.sum = self.sum * a + self.ni[:, None] * b
+        asum = self.sum * a
+        stats.outer = (
+            self.outer * np.outer(a, a)
+            + asum[:, :, None] * b
+            + asum[:, None, :] * b[:, None]
+            + self.ni[:, None, None] * np.outer(b, b)
+        )
+        bounds = np.array([self.M * a + b, self.m * a + b])
+        stats.M, stats.m = bounds.max(axis=0), bounds.min(axis=0)
+        return stats
 
 
 class GMMR:
@@ -111,21 +247,30 @@ class GMMR:
         self.L = []
         self.classnum = []  # to keep right labels
         self.tau = 0.0
+        self.stats = None  # GMMStats of each training feature, to update the model
+        self.features = None  # (label in stats, class) of each training feature
+        self.whitening = None  # (tau, W, b, S, cst) computed by get_whitening
+        self.scaling = None  # (a, b) scaling the samples, see with_scaling
 
-    def learn(self, x, y):
+    def learn(self, x, y, sample_weight=None):
         """
         Function that learns the GMM with ridge regularizationb from training samples
         Input:
             x : the training samples
             y :  the labels
+            sample_weight : number of times each sample is counted, for distinct samples (optional)
         Output:
             the mean, covariance and proportion of each class, as well as the spectral decomposition of the covariance matrix
         """
 
         ## Get information from the data
+        self.whitening = None
         C = np.unique(y).shape[0]
         # C = int(y.max(0))  # Number of classes
         n = x.shape[0]  # Number of samples
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64).ravel()
+            n = sample_weight.sum()
         d = x.shape[1]  # Number of variables
         eps = np.finfo(np.float64).eps
 
@@ -143,24 +288,77 @@ class GMMR:
             j = np.where(y == (cR))[0]
 
             self.classnum[c] = cR  # Save the right label
-            self.ni[c] = float(j.size)
+            if sample_weight is None:
+                self.ni[c] = float(j.size)
+                self.mean[c, :] = np.mean(x[j, :], axis=0)
+                self.cov[c, :, :] = np.cov(
+                    x[j, :], bias=1, rowvar=0
+                )  # Normalize by ni to be consistent with the update formulae
+            else:
+                w = sample_weight[j]
+                self.ni[c] = w.sum()
+                self.mean[c, :] = np.average(x[j, :], axis=0, weights=w)
+                self.cov[c, :, :] = np.cov(x[j, :], bias=1, rowvar=0, aweights=w)
             self.prop[c] = self.ni[c] / n
-            self.mean[c, :] = np.mean(x[j, :], axis=0)
-            self.cov[c, :, :] = np.cov(
-                x[j, :], bias=1, rowvar=0
-            )  # Normalize by ni to be consistent with the update formulae
 
-            # Spectral decomposition
+            # Spectral decomposition, constant variables get a small variance
             L, Q = linalg.eigh(self.cov[c, :, :])
+            L = np.maximum(L, eps * max(L.max(), 1.0))
             idx = L.argsort()[::-1]
             self.L[c, :] = L[idx]
             self.Q[c, :, :] = Q[:, idx]
 
-    def predict(self, xt, tau=None, proba=None):
+    def learn_stats(self, stats):
+        """
+        Function that learns the GMM from the sufficient statistics of the training samples, the
+        model is the one learned on the samples themselves
+        Input:
+            stats : a GMMStats
+        Output:
+            the mean, covariance and proportion of each class, as well as the spectral decomposition of the covariance matrix
+        """
+        ## Get information from the statistics, classes are sorted as in learn
+        self.whitening = None
+        order = np.argsort(stats.classnum)
+        C = order.size  # Number of classes
+        d = stats.sum.shape[1]  # Number of variables
+        n = stats.ni.sum()  # Number of samples
+        eps = np.finfo(np.float64).eps
+
+        ## Initialization
+        self.ni = stats.ni[order].reshape(C, 1)
+        self.prop = self.ni / n
+        self.mean = stats.sum[order, :] / self.ni
+        self.cov = np.empty((C, d, d))
+        self.Q = np.empty((C, d, d))
+        self.L = np.empty((C, d))
+        self.classnum = stats.classnum[order].astype("uint8")
+
+        for c, k in enumerate(order):
+            # Covariance normalized by ni, as in learn
+            cov = stats.outer[k, :, :] / self.ni[c] - np.outer(
+                self.mean[c, :], self.mean[c, :]
+            )
+            self.cov[c, :, :] = (cov + cov.T) / 2
+
+            # Spectral decomposition, constant variables and rounding errors of the difference get
+            # a small variance
+            L, Q = linalg.eigh(self.cov[c, :, :])
+            L = np.maximum(L, eps * max(L.max(), 1.0))
+            idx = L.argsort()[::-1]
+            self.L[c, :] = L[idx]
+            self.Q[c, :, :] = Q[:, idx]
+
+    def predict(self, xt, tau=None, proba=None, dtype=np.float32, chunk=16384):
         """
         Function that predict the label for sample xt using the learned model
+        In float32, the samples are whitened for all the classes at once with the matrices of
+        get_whitening, chunk samples at a time. The float64 computation class by class is kept to
+        validate it.
         Inputs:
             xt: the samples to be classified
+            dtype: np.float32 or np.float64, precision of the decision values
+            chunk: number of samples whitened at once in float32
         Outputs:
             y: the class
             K: the decision value for each class
@@ -170,21 +368,34 @@ class GMMR:
         C = self.ni.shape[0]  # Number of classes
 
         ## Initialization
-        K = np.empty((nt, C))
+        K = np.empty((nt, C), dtype=dtype)
 
         if tau is None:
             TAU = self.tau
         else:
             TAU = tau
 
-        for c in range(C):
-            invCov, logdet = self.compute_inverse_logdet(c, TAU)
-            cst = logdet - 2 * np.log(self.prop[c])  # Pre compute the constant
+        if dtype == np.float32:
+            W, b, S, cst = self.get_whitening(TAU)
+            for i in range(0, nt, chunk):
+                # Whitened samples of each class, their squared norm is the distance to the mean
+                Z = np.dot(xt[i : i + chunk, :].astype(np.float32), W)
+                Z += b
+                Z *= Z
+                np.dot(Z, S, out=K[i : i + chunk, :])
+                del Z
+            K += cst
+        else:
+            if getattr(self, "scaling", None) is not None:
+                xt = xt * self.scaling[0] + self.scaling[1]
+            for c in range(C):
+                invCov, logdet = self.compute_inverse_logdet(c, TAU)
+                cst = logdet - 2 * np.log(self.prop[c])  # Pre compute the constant
 
-            xtc = xt - self.mean[c, :]
-            temp = np.dot(invCov, xtc.T).T
-            K[:, c] = np.sum(xtc * temp, axis=1) + cst
-            del temp, xtc
+                xtc = xt - self.mean[c, :]
+                temp = np.dot(invCov, xtc.T).T
+                K[:, c] = np.sum(xtc * temp, axis=1) + cst
+                del temp, xtc
 
         ## Assign the label save in classnum to the minimum value of K
         yp = self.classnum[np.argmin(K, 1)]
@@ -195,6 +406,63 @@ class GMMR:
         else:
             return yp, K
 
+    def get_whitening(self, tau):
+        """
+        Function that computes the whitening of all the classes for the regularization tau, the
+        result is kept for the next calls with the same tau
+        Input:
+            tau: the regularization
+        Output:
+            W: the matrices Q/sqrt(L+tau) of the classes side by side (d x C.d, float32)
+            b: the whitened means, with a minus sign (C.d, float32)
+            S: the matrix summing the squared whitened samples of each class (C.d x C, float32)
+            cst: the log determinant and proportion term of each class, minus their minimum (C, float32)
+        """
+        whitening = getattr(self, "whitening", None)  # Models saved without it
+        if whitening is not None and whitening[0] == tau:
+            return whitening[1:]
+
+        C, d = self.mean.shape
+        Lr = self.L + tau  # Regularized eigenvalues
+        W = self.Q / np.sqrt(Lr)[:, None, :]
+        b = -np.einsum("ij,ijk->ik", self.mean, W).ravel()
+        cst = np.sum(np.log(Lr), axis=1) - 2 * np.log(self.prop.ravel())
+        # Only the differences between the classes matter, a large constant would swamp the
+        # small distances of a large tau in float32
+        cst -= cst.min()
+        W = W.transpose(1, 0, 2).reshape(d, C * d)
+        S = np.kron(np.eye(C), np.ones((d, 1)))
+        if getattr(self, "scaling", None) is not None:
+            # (x * a + s) W + b = x (a W) + (s W + b)
+            b = b + np.dot(self.scaling[1], W)
+            W = self.scaling[0][:, None] * W
+        self.whitening = (
+            tau,
+            W.astype(np.float32),
+            b.astype(np.float32),
+            S.astype(np.float32),
+            cst.astype(np.float32),
+        )
+        return self.whitening[1:]
+
+    def with_scaling(self, a, b):
+        """
+        Function that gives the model predicting the samples before their scaling x*a+b, the
+        scaling is done by the whitening matrices
+        Input:
+            a : the factor of each variable
+            b : the offset of each variable
+        Output:
+            model : a copy of the model sharing its parameters
+        """
+        model = copy.copy(self)
+        model.scaling = (
+            np.asarray(a, dtype=np.float64),
+            np.asarray(b, dtype=np.float64),
+        )
+        model.whitening = None
+        return model
+
     def compute_inverse_logdet(self, c, tau):
         Lr = self.L[c, :] + tau  # Regularized eigenvalues
         temp = self.Q[c, :, :] * (1 / Lr)
@@ -202,6 +470,36 @@ class GMMR:
         logdet = np.sum(np.log(Lr))  # Compute the log determinant
         return invCov, logdet
 
+    def decision_path(self, xt, tau):
+        """
+        Function that computes the decision values of samples for several values of the regularization.
+        The samples are projected once on the eigenvectors of each class, each tau only rescales
+        the squared projections by 1/(L+tau).
+        Inputs:
+            xt: the samples
+            tau: the values of the regularization
+        Outputs:
+            K: the decision value of each sample for each tau and each class (nt x ntau x C)
+        """
+        ## Get information from the data
+        nt = xt.shape[0]  # Number of testing samples
+        C = self.ni.shape[0]  # Number of classes
+        tau = np.asarray(tau, dtype=np.float64).ravel()
+        if getattr(self, "scaling", None) is not None:
+            xt = xt * self.scaling[0] + self.scaling[1]
+
+        ## Initialization
+        K = np.empty((nt, tau.size, C))
+
+        for c in range(C):
+            P = np.dot(xt - self.mean[c, :], self.Q[c, :, :]) ** 2
+            Lr = self.L[c, :] + tau[:, None]  # Regularized eigenvalues for each tau
+            cst = np.sum(np.log(Lr), axis=1) - 2 * np.log(self.prop[c])
+            K[:, :, c] = np.dot(P, (1 / Lr).T) + cst
+            del P
+
+        return K
+
     def BIC(self, x, y, tau=None):
         """Computes the Bayesian Information Criterion of the model"""
         ## Get information from the data
@@ -221,7 +519,7 @@ class GMMR:
         ## Compute the log-likelihood
         L = 0
         for c in range(C):
-            j = np.where(y == (c + 1))[0]
+            j = np.where(y.ravel() == self.classnum[c])[0]
             xi = x[j, :]
             invCov, logdet = self.compute_inverse_logdet(c, TAU)
             cst = logdet - 2 * np.log(self.prop[c])  # Pre compute the constant
@@ -233,48 +531,68 @@ class GMMR:
 
         return L + P
 
-    def cross_validation(self, x, y, tau, v=5):
+    def cross_validation(
+        self, x, y, tau, v=5, criterion="accuracy", sample_weight=None, fold=None
+    ):
         """
-        Function that computes the cross validation accuracy for the value tau of the regularization
+        Function that computes the cross validation accuracy or BIC for the values tau of the regularization
+        Each fold model computes the decision values of its testing samples for all the tau at once
+        (see decision_path).
         Input:
             x : the training samples
             y : the labels
             tau : a range of values to be tested
             v : the number of fold
+            criterion : "accuracy" (the highest) or "BIC" (the lowest) to select tau
+            sample_weight : number of times each sample is counted, for distinct samples (optional)
+            fold : the fold of each sample, from 0 to v-1, random folds of each class if None
         Output:
-            err : the estimated error with cross validation for all tau's value
+            tau : the selected value
+            err : the estimated accuracy or BIC with cross validation for all tau's value
         """
         ## Initialization
+        y = np.asarray(y).ravel()
+        tau = np.asarray(tau, dtype=np.float64).ravel()
         ns = x.shape[0]  # Number of samples
-        np = tau.size  # Number of parameters to test
+        if sample_weight is None:
+            w = np.ones(ns)
+        else:
+            w = np.asarray(sample_weight, dtype=np.float64).ravel()
         cv = CV()  # Initialization of the indices for the cross validation
-        cv.split_data_class(y)
-        err = np.zeros(np)  # Initialization of the errors
-
-        ## Create GMM model for each fold
-        model_cv = []
-        for i in range(v):
-            model_cv.append(GMMR())
-            model_cv[i].learn(x[cv.it[i], :], y[cv.it[i]])
-
-        ## Initialization of the pool of processes
-        pool = mp.Pool()
-        processes = [
-            pool.apply_async(
-                predict, args=(tau, model_cv[i], x[cv.iT[i], :], y[cv.iT[i]])
-            )
-            for i in range(v)
-        ]
-        pool.close()
-        pool.join()
-        for p in processes:
-            err += p.get()
-        err /= v
-
-        ## Free memory
-        for model in model_cv:
-            del model
-
-        del processes, pool, model_cv
-
-        return tau[err.argmax()], err
+        if fold is None:
+            cv.split_data_class(y, v)
+        else:
+            cv.split_data_fold(fold, v)
+        err = np.zeros(tau.size)  # Initialization of the errors
+
+        ## Create GMM model for each fold and test it for all tau
+        for it, iT in zip(cv.it, cv.iT):
+            if it.size == 0 or iT.size == 0:
+                continue
+            model = GMMR()
+            if sample_weight is None:
+                model.learn(x[it, :], y[it])
+            else:
+                model.learn(x[it, :], y[it], sample_weight=w[it])
+            for t in np.array_split(iT, max(1, iT.size // 10000)):
+                K = model.decision_path(x[t, :], tau)
+                if criterion == "BIC":
+                    # Decision value of the samples in their own class, classes missing in the fold are ignored
+                    c = np.minimum(
+                        np.searchsorted(model.classnum, y[t]), model.classnum.size - 1
+                    )
+                    ok = np.where(model.classnum[c] == y[t])[0]
+                    err += np.dot(w[t[ok]], K[ok, :, c[ok]])
+                else:
+                    yp = model.classnum[np.argmin(K, axis=2)]
+                    err += np.dot(w[t], yp == y[t, None])
+                del K
+
+        if criterion == "BIC":
+            ## Penalization
+            C, d = np.unique(y).size, x.shape[1]
+            err += (C * (d * (d + 3) / 2) + (C - 1)) * np.log(w.sum())
+            return tau[err.argmin()], err
+        else:
+            err *= 100.0 / w[np.concatenate(cv.iT)].sum()
+            return tau[err.argmax()], err
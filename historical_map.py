@@ -24,12 +24,15 @@
 from __future__ import annotations
 
 import os.path
+import tempfile
+import time
 
-from qgis.core import QgsMessageLog
+from qgis.core import QgsCoordinateTransform, QgsMessageLog, QgsProject
 from qgis.PyQt.QtCore import QCoreApplication, QSettings, QTranslator, qVersion
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction, QDialog, QMessageBox
 
+import HistoricalMap.function_dataraster as dataraster
 import HistoricalMap.function_historical_map as fhm
 
 # Initialize Qt resources from file resources.py
@@ -90,6 +93,10 @@ class HistoricalMap(QDialog):
         self.dlg.outMatrix.setFilePath("")
 
         self.dlg.btnFilter.clicked.connect(self.runFilter)
+        self.dlg.btnPreview.clicked.connect(self.runPreview)
+        self.previewLayer = None
+        self.previewFile = None
+        self.previewCount = 0
         self.dlg.btnTrain.clicked.connect(self.runTrain)
         self.dlg.btnClassify.clicked.connect(self.runClassify)
         self.dlg.inModel.setFilePath("")
@@ -116,6 +123,10 @@ class HistoricalMap(QDialog):
         ## hide/show nfolds spinbox
         self.dlg.nFolds.hide()
 
+        ## filter with all the cores by default
+        self.dlg.inJobs.setMaximum(os.cpu_count() or 1)
+        self.dlg.inJobs.setValue(os.cpu_count() or 1)
+
     """ uncomment for nfold support
     self.dlg.inClassifier.currentIndexChanged[int].connect(self.nfolds)
         
@@ -244,6 +255,7 @@ class HistoricalMap(QDialog):
 
     def unload(self):
         """!@brief Removes the plugin menu item and icon from QGIS GUI."""
+        self.removePreview()
         for action in self.actions:
             self.iface.removePluginRasterMenu(self.tr("&Historical Map"), action)
             self.iface.removeToolBarIcon(action)
@@ -253,6 +265,42 @@ class HistoricalMap(QDialog):
     def showDlg(self):
         self.dlg.show()
 
+    def getCanvasWindow(self, layer):
+        """!@brief Pixel window of a raster layer shown in the map canvas
+
+        Input :
+            layer : raster layer (QgsRasterLayer)
+        Output :
+            (xoff, yoff, xsize, ysize) window clipped to the raster, None if the
+            canvas does not show the raster
+        """
+        canvas = self.iface.mapCanvas()
+        transform = QgsCoordinateTransform(
+            canvas.mapSettings().destinationCrs(), layer.crs(), QgsProject.instance()
+        )
+        extent = transform.transformBoundingBox(canvas.extent())
+        extent = extent.intersect(layer.extent())
+        if extent.isEmpty():
+            return None
+
+        layerExtent = layer.extent()
+        resX = layer.rasterUnitsPerPixelX()
+        resY = layer.rasterUnitsPerPixelY()
+        xoff = int((extent.xMinimum() - layerExtent.xMinimum()) / resX)
+        yoff = int((layerExtent.yMaximum() - extent.yMaximum()) / resY)
+        xend = min(
+            layer.width(),
+            int(round((extent.xMaximum() - layerExtent.xMinimum()) / resX)),
+        )
+        yend = min(
+            layer.height(),
+            int(round((layerExtent.yMaximum() - extent.yMinimum()) / resY)),
+        )
+        if xend <= xoff or yend <= yoff:
+            return None
+
+        return xoff, yoff, xend - xoff, yend - yoff
+
     def runFilter(self):
         """!@brief Performs the filtering of the map by calling function_historical_map.py
 
@@ -291,11 +339,71 @@ class HistoricalMap(QDialog):
             inShapeMedian = self.dlg.inShapeMedian.value()
             outRaster = self.dlg.outRaster.filePath()
             iterMedian = self.dlg.inShapeMedianIter.value()
+            inJobs = self.dlg.inJobs.value()
+            inResolution = self.dlg.inResolution.value() or None
 
             # Do the job
+            if self.dlg.inSweep.isChecked():
+                try:
+                    listGrey = [int(x) for x in self.dlg.inSweepGrey.text().split(",")]
+                    listMedian = [
+                        int(x) for x in self.dlg.inSweepMedian.text().split(",")
+                    ]
+                    listIter = [int(x) for x in self.dlg.inSweepIter.text().split(",")]
+                except ValueError:
+                    QMessageBox.warning(
+                        self,
+                        "Information missing or invalid",
+                        "Sweep sizes and iterations have to be integers separated by commas",
+                        QMessageBox.Ok,
+                    )
+                    return
+                window = self.getCanvasWindow(self.dlg.inRaster.currentLayer())
+                if window is None:
+                    QMessageBox.warning(
+                        self,
+                        "Information missing or invalid",
+                        "The image to filter is not shown in the map canvas",
+                        QMessageBox.Ok,
+                    )
+                    return
+                sweep = fhm.filterSweep(
+                    inRaster,
+                    outRaster,
+                    listGrey,
+                    listMedian,
+                    listIter,
+                    inWindow=window,
+                )
+                self.iface.messageBar().pushMessage(
+                    "New images",
+                    str(len(sweep.outNames)) + " filtered images of the canvas extent",
+                    3,
+                    10,
+                )
+                for outName in sweep.outNames:
+                    self.iface.addRasterLayer(outName)
+                return
+
+            # The classification uses the mask next to the filtered image, the one of an
+            # earlier filter of outRaster must not be kept
+            inMask = dataraster.get_mask_name(outRaster)
+            if self.dlg.inFrame.isChecked():
+                inMask = dataraster.get_map_mask(inRaster, inMask)
+            else:
+                if os.path.exists(inMask):
+                    os.remove(inMask)
+                inMask = None
 
             fhm.historicalFilter(
-                inRaster, outRaster, inShapeGrey, inShapeMedian, iterMedian
+                inRaster,
+                outRaster,
+                inShapeGrey,
+                inShapeMedian,
+                iterMedian,
+                inJobs=inJobs,
+                inResolution=inResolution,
+                inMask=inMask,
             )
 
             # Show what's done
@@ -315,11 +423,87 @@ class HistoricalMap(QDialog):
             #         self, "Problem while filtering", "Please show log", QMessageBox.Ok
             #     )
 
+    def runPreview(self):
+        """!@brief Filter the canvas extent at screen resolution in a temporary layer
+
+        Only the part of the image shown in the map canvas is read, decimated to the size of
+        the canvas, so the filter parameters can be tried in a few seconds.
+        The previous preview layer is replaced by the new one.
+        """
+        layer = self.dlg.inRaster.currentLayer()
+        if layer is None:
+            QMessageBox.warning(
+                self,
+                "Information missing or invalid",
+                "You have to specify a tif in image to filter",
+                QMessageBox.Ok,
+            )
+            return
+        window = self.getCanvasWindow(layer)
+        if window is None:
+            QMessageBox.warning(
+                self,
+                "Information missing or invalid",
+                "The image to filter is not shown in the map canvas",
+                QMessageBox.Ok,
+            )
+            return
+
+        inRaster = layer.dataProvider().dataSourceUri()
+        inShapeGrey = self.dlg.inShapeGrey.value()
+        inShapeMedian = self.dlg.inShapeMedian.value()
+        iterMedian = self.dlg.inShapeMedianIter.value()
+        canvas = self.iface.mapCanvas()
+
+        # A new file each time, the previous one can still be locked by Qgis
+        self.previewCount += 1
+        outRaster = os.path.join(
+            tempfile.gettempdir(),
+            f"historical_map_preview_{os.getpid()}_{self.previewCount}.tif",
+        )
+        start = time.time()
+        preview = fhm.filterPreview(
+            inRaster,
+            outRaster,
+            inShapeGrey,
+            inShapeMedian,
+            iterMedian,
+            window,
+            (canvas.width(), canvas.height()),
+        )
+        QgsMessageLog.logMessage(
+            f"Preview of {window} decimated by {preview.factor} "
+            f"in {time.time() - start:.2f} s"
+        )
+
+        self.removePreview()
+        self.previewFile = outRaster
+        newLayer = self.iface.addRasterLayer(outRaster, "Filter preview")
+        if newLayer is not None:
+            self.previewLayer = newLayer.id()
+
+    def removePreview(self):
+        """!@brief Remove the preview layer from the project and delete its file"""
+        if self.previewLayer is not None and QgsProject.instance().mapLayer(
+            self.previewLayer
+        ):
+            QgsProject.instance().removeMapLayer(self.previewLayer)
+        self.previewLayer = None
+        if self.previewFile is not None:
+            for name in (self.previewFile, self.previewFile + ".aux.xml"):
+                if os.path.exists(name):
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        QgsMessageLog.logMessage(f"Cannot delete the preview {name}")
+            self.previewFile = None
+
     def runTrain(self):
         """!@brief Performs the training by calling function_historical_map.py
 
         First step is validating the form, then if all is ok, proceed to the training.
         Tell the user who don't have sklearn they can't use classifier except GMM.
+        With "Update model", the GMM of the model file is updated with the changed polygons.
 
             Input :
                 Fields from the form
@@ -330,7 +514,7 @@ class HistoricalMap(QDialog):
         message = ""
         if self.dlg.outModel.filePath() == "":
             message = "Sorry, you have to specify as model name"
-        if self.dlg.outMatrix.filePath() == "":
+        if self.dlg.outMatrix.filePath() == "" and not self.dlg.inUpdate.isChecked():
             message = "Sorry, you have to specify as matrix name"
         if not self.dlg.inClassifier.currentText() == "GMM":
             # try:
@@ -362,9 +546,30 @@ class HistoricalMap(QDialog):
             inSeed = self.dlg.inSeed.value()
             inSeed = int(inSeed)
             inSplit = self.dlg.inSplit.value()
+            inMaxSamples = self.dlg.inMaxSamples.value() or None
             # nFolds=self.dlg.nFolds.value()
             # add model to step 3
             self.dlg.inModel.setFilePath(outModel)
+            if self.dlg.inUpdate.isChecked():
+                # Only the polygons changed since the model was learned are read
+                update = fhm.updateModel(
+                    inFiltered,
+                    inTraining,
+                    inField,
+                    outModel,
+                    inJobs=self.dlg.inJobs.value(),
+                )
+                if update.message is not None:
+                    QMessageBox.warning(
+                        self, "Model not updated", update.message, QMessageBox.Ok
+                    )
+                else:
+                    QMessageBox.information(
+                        self,
+                        "Information",
+                        f"Model is updated!<br>Model saved at {outModel}.",
+                    )
+                return
             # Do the job
             fhm.learnModel(
                 inFiltered,
@@ -375,6 +580,9 @@ class HistoricalMap(QDialog):
                 outModel,
                 outMatrix,
                 inClassifier,
+                inMaxSamples=inMaxSamples,
+                inJobs=self.dlg.inJobs.value(),
+                inLUT=self.dlg.inLUT.isChecked(),
             )
 
             # show where it is saved
@@ -428,19 +636,25 @@ class HistoricalMap(QDialog):
             outShp = str(self.dlg.outShp.filePath())
             inClassForest = int(self.dlg.inClassForest.value())
             # do the job
-            classify = fhm.classifyImage()
+            classify = fhm.classifyImage(self.dlg.inResolution.value() or None)
             inMinSize = inMinSize * 10000  # convert ha to m squared
+            # Mask of the map, if it was detected when filtering
+            inMask = dataraster.get_mask_name(inFilteredStep3)
+            if not os.path.exists(inMask):
+                inMask = None
             # try:
-            temp = classify.initPredict(inFilteredStep3, inModel)
+            temp = classify.initPredict(inFilteredStep3, inModel, inMask)
             # except:
             #     QgsMessageLog.logMessage("Problem while predicting image")
 
             if self.dlg.filterByPixel.isChecked():  # sieve by pixel number (raster)
                 temp = classify.postClassRaster(
-                    temp, int(inMinSize), inClassForest, outShp
+                    temp, int(inMinSize), inClassForest, outShp, inMask
                 )
             else:  # sieve by area (vector)
-                temp = classify.postClassVector(temp, inMinSize, inClassForest, outShp)
+                temp = classify.postClassVector(
+                    temp, inMinSize, inClassForest, outShp, inMask
+                )
 
             # Add layer
             self.iface.addVectorLayer(outShp, "Vectorized class", "ogr")
@@ -179,6 +179,14 @@ class Ui_HistoricalMap(object):
         self.btnFilter.setDefault(False)
         self.btnFilter.setFlat(False)
         self.btnFilter.setObjectName("btnFilter")
+        self.btnPreview = QtWidgets.QPushButton(self.tab)
+        self.btnPreview.setGeometry(QtCore.QRect(214, 263, 150, 50))
+        self.btnPreview.setMinimumSize(QtCore.QSize(150, 50))
+        self.btnPreview.setMaximumSize(QtCore.QSize(120, 50))
+        self.btnPreview.setAutoDefault(False)
+        self.btnPreview.setDefault(False)
+        self.btnPreview.setFlat(False)
+        self.btnPreview.setObjectName("btnPreview")
         self.outRaster = QgsFileWidget(self.tab)
         self.outRaster.setGeometry(QtCore.QRect(161, 190, 284, 25))
         font = QtGui.QFont()
@@ -197,6 +205,77 @@ class Ui_HistoricalMap(object):
         )
         self.label_22.setScaledContents(True)
         self.label_22.setObjectName("label_22")
+        self.tiffImageLabel_20 = QtWidgets.QLabel(self.tab)
+        self.tiffImageLabel_20.setGeometry(QtCore.QRect(312, 158, 68, 17))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(12)
+        self.tiffImageLabel_20.setFont(font)
+        self.tiffImageLabel_20.setObjectName("tiffImageLabel_20")
+        self.inJobs = QgsSpinBox(self.tab)
+        self.inJobs.setGeometry(QtCore.QRect(386, 152, 80, 25))
+        self.inJobs.setMinimumSize(QtCore.QSize(70, 25))
+        self.inJobs.setMaximumSize(QtCore.QSize(80, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inJobs.setFont(font)
+        self.inJobs.setMinimum(1)
+        self.inJobs.setMaximum(64)
+        self.inJobs.setProperty("value", 1)
+        self.inJobs.setObjectName("inJobs")
+        self.tiffImageLabel_21 = QtWidgets.QLabel(self.tab)
+        self.tiffImageLabel_21.setGeometry(QtCore.QRect(9, 158, 151, 17))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(12)
+        self.tiffImageLabel_21.setFont(font)
+        self.tiffImageLabel_21.setObjectName("tiffImageLabel_21")
+        self.inResolution = QtWidgets.QDoubleSpinBox(self.tab)
+        self.inResolution.setGeometry(QtCore.QRect(167, 152, 99, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inResolution.setFont(font)
+        self.inResolution.setDecimals(2)
+        self.inResolution.setMaximum(1000.0)
+        self.inResolution.setSingleStep(0.5)
+        self.inResolution.setObjectName("inResolution")
+        self.inFrame = QtWidgets.QCheckBox(self.tab)
+        self.inFrame.setGeometry(QtCore.QRect(9, 270, 200, 20))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(12)
+        self.inFrame.setFont(font)
+        self.inFrame.setObjectName("inFrame")
+        self.inSweep = QtWidgets.QCheckBox(self.tab)
+        self.inSweep.setGeometry(QtCore.QRect(9, 228, 150, 20))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(12)
+        self.inSweep.setFont(font)
+        self.inSweep.setObjectName("inSweep")
+        self.inSweepGrey = QtWidgets.QLineEdit(self.tab)
+        self.inSweepGrey.setGeometry(QtCore.QRect(167, 226, 60, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inSweepGrey.setFont(font)
+        self.inSweepGrey.setObjectName("inSweepGrey")
+        self.inSweepMedian = QtWidgets.QLineEdit(self.tab)
+        self.inSweepMedian.setGeometry(QtCore.QRect(232, 226, 60, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inSweepMedian.setFont(font)
+        self.inSweepMedian.setObjectName("inSweepMedian")
+        self.inSweepIter = QtWidgets.QLineEdit(self.tab)
+        self.inSweepIter.setGeometry(QtCore.QRect(297, 226, 60, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inSweepIter.setFont(font)
+        self.inSweepIter.setObjectName("inSweepIter")
         self.tabWidget.addTab(self.tab, "")
         self.tab_2 = QtWidgets.QWidget()
         self.tab_2.setObjectName("tab_2")
@@ -404,6 +483,29 @@ class Ui_HistoricalMap(object):
         self.label_9.setScaledContents(True)
         self.label_9.setObjectName("label_9")
         self.gridLayout_23.addWidget(self.label_9, 0, 2, 1, 1)
+        self.tiffImageLabel_22 = QtWidgets.QLabel(self.tab_2)
+        self.tiffImageLabel_22.setGeometry(QtCore.QRect(372, 190, 150, 17))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(12)
+        self.tiffImageLabel_22.setFont(font)
+        self.tiffImageLabel_22.setObjectName("tiffImageLabel_22")
+        self.inMaxSamples = QgsSpinBox(self.tab_2)
+        self.inMaxSamples.setGeometry(QtCore.QRect(372, 214, 150, 25))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inMaxSamples.setFont(font)
+        self.inMaxSamples.setMaximum(10000000)
+        self.inMaxSamples.setSingleStep(1000)
+        self.inMaxSamples.setObjectName("inMaxSamples")
+        self.inUpdate = QtWidgets.QCheckBox(self.tab_2)
+        self.inUpdate.setGeometry(QtCore.QRect(372, 241, 150, 20))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inUpdate.setFont(font)
+        self.inUpdate.setObjectName("inUpdate")
         self.btnTrain = QtWidgets.QPushButton(self.tab_2)
         self.btnTrain.setGeometry(QtCore.QRect(372, 263, 150, 50))
         sizePolicy = QtWidgets.QSizePolicy(
@@ -425,6 +527,13 @@ class Ui_HistoricalMap(object):
         self.nFolds.setGeometry(QtCore.QRect(350, 79, 111, 27))
         self.nFolds.setProperty("value", 3)
         self.nFolds.setObjectName("nFolds")
+        self.inLUT = QtWidgets.QCheckBox(self.tab_2)
+        self.inLUT.setGeometry(QtCore.QRect(372, 81, 150, 20))
+        font = QtGui.QFont()
+        font.setFamily("Arial")
+        font.setPointSize(10)
+        self.inLUT.setFont(font)
+        self.inLUT.setObjectName("inLUT")
         self.outModel = QgsFileWidget(self.tab_2)
         self.outModel.setGeometry(QtCore.QRect(170, 114, 321, 27))
         font = QtGui.QFont()
@@ -708,7 +817,53 @@ class Ui_HistoricalMap(object):
         self.tiffImageLabel_3.setText(
             _translate("HistoricalMap", "Size of median filter :")
         )
+        self.tiffImageLabel_20.setText(_translate("HistoricalMap", "Cores :"))
+        self.inJobs.setToolTip(
+            _translate("HistoricalMap", "Number of tiles filtered in parallel")
+        )
+        self.tiffImageLabel_21.setText(_translate("HistoricalMap", "Resolution :"))
+        self.inResolution.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Ground resolution of the filtered image, the image is averaged to it first. Filter sizes are in pixels of the image",
+            )
+        )
+        self.inResolution.setSpecialValueText(_translate("HistoricalMap", "Native"))
+        self.inResolution.setSuffix(_translate("HistoricalMap", " m"))
+        self.inFrame.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Find the map inside the sheet collar, the margins, legend and frame are not filtered nor classified (the mask is saved next to the filtered image)",
+            )
+        )
+        self.inFrame.setText(_translate("HistoricalMap", "Detect map frame"))
+        self.inSweep.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Filter the part of the image shown in the map canvas with every combination of the closing sizes, median sizes and iterations (comma separated)",
+            )
+        )
+        self.inSweep.setText(_translate("HistoricalMap", "Parameter sweep :"))
+        self.inSweepGrey.setToolTip(
+            _translate("HistoricalMap", "Sizes of closing filter")
+        )
+        self.inSweepGrey.setText(_translate("HistoricalMap", "7,11,15"))
+        self.inSweepMedian.setToolTip(
+            _translate("HistoricalMap", "Sizes of median filter")
+        )
+        self.inSweepMedian.setText(_translate("HistoricalMap", "7,11,15"))
+        self.inSweepIter.setToolTip(
+            _translate("HistoricalMap", "Numbers of iterations")
+        )
+        self.inSweepIter.setText(_translate("HistoricalMap", "1,3,5"))
         self.btnFilter.setText(_translate("HistoricalMap", "Filter"))
+        self.btnPreview.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Filter the part of the image shown in the map canvas, at screen resolution, in a temporary layer",
+            )
+        )
+        self.btnPreview.setText(_translate("HistoricalMap", "Preview"))
         self.outRaster.setFilter(_translate("HistoricalMap", "*.tif"))
         self.label_22.setToolTip(
             _translate(
@@ -786,8 +941,32 @@ class Ui_HistoricalMap(object):
                 "<html><head/><body><p>By default you must have a column nammed 'Class' where you put the id of your segmentation (1 for Forest, 2 for Water... You must leave 0 for the script). You can choose here your column.</p></body></html>",
             )
         )
+        self.tiffImageLabel_22.setText(
+            _translate("HistoricalMap", "Samples per class :")
+        )
+        self.inMaxSamples.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Maximum number of pixels per class used for training, drawn at random with the seed",
+            )
+        )
+        self.inMaxSamples.setSpecialValueText(_translate("HistoricalMap", "All"))
+        self.inUpdate.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Add the new or changed polygons to the GMM of the model file and remove the deleted ones, the other polygons are not read again",
+            )
+        )
+        self.inUpdate.setText(_translate("HistoricalMap", "Update model"))
         self.btnTrain.setText(_translate("HistoricalMap", "Train"))
         self.nFolds.setSuffix(_translate("HistoricalMap", " folds"))
+        self.inLUT.setToolTip(
+            _translate(
+                "HistoricalMap",
+                "Save the label of every colour in the model (images of at most 3 bands of 8 bits), the classification then only looks the pixels up",
+            )
+        )
+        self.inLUT.setText(_translate("HistoricalMap", "Colour table"))
         self.outMatrix.setFilter(_translate("HistoricalMap", "*.csv"))
         self.tabWidget.setTabText(
             self.tabWidget.indexOf(self.tab_2),